@@ -4,13 +4,19 @@ import json
 import logging
 import logging.config
 import yaml
-from pykafka import KafkaClient
 import os
+import sys
 import time
+import zlib
+import operator
+from array import array
 from datetime import datetime
 import httpx
+from flask import Response
 from connexion.middleware import MiddlewarePosition
 from starlette.middleware.cors import CORSMiddleware
+from indexer import TopicIndexer
+from kafka_pool import KafkaClientPool
 
 os.environ["LOG_FILENAME"] = "/app/logs/analyzer.log"
 
@@ -27,123 +33,150 @@ logger.debug(f"Loaded config: {json.dumps(app_config, indent=2)}")
 
 # Define consistency check file path
 CONSISTENCY_FILE = "./consistency_check.json"  # Changed to a relative path
-client = KafkaClient(hosts=f"{app_config['events']['hostname']}:{app_config['events']['port']}")
-topic = client.topics[app_config['events']['topic'].encode()]
+# One client and a pool of consumers shared by every request thread
+kafka_pool = KafkaClientPool(
+    hostname=f"{app_config['events']['hostname']}:{app_config['events']['port']}",
+    topic=app_config['events']['topic'],
+    max_idle_consumers=app_config['events'].get('max_idle_consumers', 4)
+)
+
+indexer = TopicIndexer(kafka_pool)
+SNAPSHOT_FILE = app_config.get('snapshot', {}).get('filename', '/app/data/analyzer_index.snapshot')
+SNAPSHOT_INTERVAL = app_config.get('snapshot', {}).get('interval', 60)
+
+def get_event_at_index(event_type, index):
+    position = indexer.lookup(event_type, index)
+    if position is None:
+        return None
+
+    msg = indexer.fetch(*position)
+    if msg is None:
+        return None
+    return msg["payload"]
 
 def get_telemetry_index(index):
     logger.info(f"Fetching telemetry data at index {index}")
-    
-    consumer = topic.get_simple_consumer(reset_offset_on_start=True, consumer_timeout_ms=1000)
-
-    try:
-        counter = 0
-        for msg in consumer:
-            msg_str = msg.value.decode("utf-8")
-            msg = json.loads(msg_str)
-            if msg["type"] == "telemetry_data" and counter == index:
-                logger.info(f"Telemetry data found at index {index}")
-                return msg["payload"], 200
-            if msg["type"] == "telemetry_data":
-                counter += 1
+
+    payload = get_event_at_index("telemetry_data", index)
+    if payload is None:
         logger.warning(f"Telemetry data not found at index {index}")
         return {"message": "Not Found"}, 404
-    finally:
-        consumer.stop()  # Explicitly stop the consumer to ensure cleanup
+
+    logger.info(f"Telemetry data found at index {index}")
+    return payload, 200
 
 def get_race_event_index(index):
     logger.info(f"Fetching race event at index {index}")
-    consumer = topic.get_simple_consumer(reset_offset_on_start=True, consumer_timeout_ms=1000)
-
-    try:
-        counter = 0
-        for msg in consumer:
-            msg_str = msg.value.decode("utf-8")
-            msg = json.loads(msg_str)
-            logger.debug(f"Consumed message: {msg}")
-            if msg["type"] == "race_events" and counter == index:
-                logger.info(f"Race event found at index {index}")
-                return msg["payload"], 200
-            if msg["type"] == "race_events":
-                counter += 1
+
+    payload = get_event_at_index("race_events", index)
+    if payload is None:
         logger.warning(f"Race event not found at index {index}")
         return {"message": "Not Found"}, 404
-    finally:
-        consumer.stop()  # Explicitly stop the consumer to ensure cleanup
 
-def get_stats():
+    logger.info(f"Race event found at index {index}")
+    return payload, 200
+
+def get_stats(verify=False):
     logger.info("Fetching statistics")
 
-    client = KafkaClient(hosts=f"{app_config['events']['hostname']}:{app_config['events']['port']}")
-    
-    telemetry_topic = client.topics[app_config['events']['topic'].encode()]
-    telemetry_consumer = telemetry_topic.get_simple_consumer(reset_offset_on_start=True, consumer_timeout_ms=1000)
-    telemetry_count = sum(1 for msg in telemetry_consumer if msg and json.loads(msg.value.decode("utf-8"))["type"] == "telemetry_data")
-    
-    race_topic = client.topics[app_config['events']['topic'].encode()]
-    race_consumer = race_topic.get_simple_consumer(reset_offset_on_start=True, consumer_timeout_ms=1000)
-    race_count = sum(1 for msg in race_consumer if msg and json.loads(msg.value.decode("utf-8"))["type"] == "race_events")
-    
+    # Counts are kept up to date by the indexer, no need to scan the topic
+    counts = indexer.counts()
+    stats = {
+        "telemetry_data": counts["telemetry_data"],
+        "race_events": counts["race_events"]
+    }
+
+    if verify:
+        logger.info("Verifying statistics with a full rescan of the topic")
+        rescanned, indexed = indexer.verify()
+        stats["verified"] = rescanned == indexed
+        stats["rescan"] = rescanned
+        if not stats["verified"]:
+            logger.error(f"Indexed counts {indexed} do not match a full rescan {rescanned}")
+
     logger.info("Statistics fetched successfully")
-    return {
-        "telemetry_data": telemetry_count,
-        "race_events": race_count
-    }, 200
-
-def get_telemetry_trace_ids():
-    try:
-        client = KafkaClient(hosts=f"{app_config['events']['hostname']}:{app_config['events']['port']}")
-        topic = client.topics[app_config['events']['topic'].encode()]
-        consumer = topic.get_simple_consumer(reset_offset_on_start=True, consumer_timeout_ms=1000)
-        
-        results = []
-        for msg in consumer:
-            if msg:
-                msg_str = msg.value.decode("utf-8")
-                msg_data = json.loads(msg_str)
-                if msg_data["type"] == "telemetry_data" and "payload" in msg_data:
-                    payload = msg_data["payload"]
-                    if "telemetry_id" in payload and "trace_id" in payload:
-                        results.append({
-                            "telemetry_id": payload["telemetry_id"],
-                            "trace_id": payload["trace_id"]
-                        })
-        
-        logger.debug(f"Retrieved {len(results)} telemetry trace IDs from Kafka")
-        
-        return results, 200
-    except Exception as e:
-        logger.error(f"Error retrieving telemetry trace IDs from Kafka: {str(e)}")
-        return {"message": f"Error: {str(e)}"}, 500
-
-def get_race_trace_ids():
+    return stats, 200
+
+def page_headers(offset, count, total):
+    headers = {"X-Total-Count": str(total)}
+    if offset + count < total:
+        headers["X-Next-Offset"] = str(offset + count)
+    return headers
+
+def get_trace_id_pairs(event_type, offset, limit, after_trace_id, until_trace_id, buckets=None, bucket=None):
+    """Returns a page of (event id, trace id) pairs and the total number of
+    pairs. Without a trace id range or bucket filter the pairs are in topic
+    order, with one they are sorted by trace id."""
+    stop = None if limit is None else offset + limit
+    if bucket:
+        _, positions = indexer.trace_ids_in_buckets(event_type, buckets, bucket, after_trace_id, until_trace_id)
+        return indexer.trace_id_pairs_at(event_type, positions[offset:stop]), len(positions)
+    if after_trace_id is None and until_trace_id is None:
+        return indexer.trace_id_pairs(event_type, offset, stop), indexer.counts()[event_type]
+
+    _, positions = indexer.trace_id_range(event_type, after_trace_id, until_trace_id)
+    return indexer.trace_id_pairs_at(event_type, positions[offset:stop]), len(positions)
+
+def get_telemetry_trace_ids(offset=0, limit=None, after_trace_id=None, until_trace_id=None, buckets=256, bucket=None):
+    logger.info("GET request received for telemetry trace IDs from Kafka")
+
+    pairs, total = get_trace_id_pairs("telemetry_data", offset, limit, after_trace_id, until_trace_id, buckets, bucket)
+    results = [{"telemetry_id": telemetry_id, "trace_id": trace_id} for telemetry_id, trace_id in pairs]
+
+    logger.debug(f"Retrieved {len(results)} telemetry trace IDs from Kafka")
+    return results, 200, page_headers(offset, len(results), total)
+
+def get_race_trace_ids(offset=0, limit=None, after_trace_id=None, until_trace_id=None, buckets=256, bucket=None):
     logger.info("GET request received for race event trace IDs from Kafka")
-    
-    try:
-        client = KafkaClient(hosts=f"{app_config['events']['hostname']}:{app_config['events']['port']}")
-        topic = client.topics[app_config['events']['topic'].encode()]
-        consumer = topic.get_simple_consumer(reset_offset_on_start=True, consumer_timeout_ms=1000)
-        
-        results = []
-        for msg in consumer:
-            if msg:
-                msg_str = msg.value.decode("utf-8")
-                msg_data = json.loads(msg_str)
-                if msg_data["type"] == "race_events" and "payload" in msg_data:
-                    payload = msg_data["payload"]
-                    if "event_id" in payload and "trace_id" in payload:
-                        results.append({
-                            "event_id": payload["event_id"],
-                            "trace_id": payload["trace_id"]
-                        })
-        
-        logger.debug(f"Retrieved {len(results)} race event trace IDs from Kafka")
-        logger.info("GET request for race event trace IDs completed")
-        
-        return results, 200
-    except Exception as e:
-        logger.error(f"Error retrieving race event trace IDs from Kafka: {str(e)}")
-        return {"message": f"Error: {str(e)}"}, 500
 
+    pairs, total = get_trace_id_pairs("race_events", offset, limit, after_trace_id, until_trace_id, buckets, bucket)
+    results = [{"event_id": event_id, "trace_id": trace_id} for event_id, trace_id in pairs]
+
+    logger.debug(f"Retrieved {len(results)} race event trace IDs from Kafka")
+    logger.info("GET request for race event trace IDs completed")
+    return results, 200, page_headers(offset, len(results), total)
+
+def get_trace_id_digest(event_type, buckets=256, after_trace_id=None, until_trace_id=None):
+    logger.info(f"GET request received for the {event_type} trace ID digest")
+
+    counts, digests = indexer.bucket_digests(event_type, buckets, after_trace_id, until_trace_id)
+
+    logger.debug(f"Computed {buckets} bucket digests over {sum(counts)} {event_type} trace IDs")
+    return {"buckets": buckets, "counts": counts, "digests": digests}, 200
+
+def encode_trace_ids(trace_ids, encoding):
+    """raw: little endian int64 values. delta: the first value followed by
+    the difference to the previous one, as little endian int64, zlib
+    compressed. Sorted ids are close together, so the deltas compress well."""
+    if encoding == "delta" and trace_ids:
+        trace_ids = array('q', [trace_ids[0]]) + array('q', map(operator.sub, trace_ids[1:], trace_ids[:-1]))
+    if sys.byteorder == "big":
+        trace_ids = array('q', trace_ids)
+        trace_ids.byteswap()
+    data = trace_ids.tobytes()
+    if encoding == "delta":
+        data = zlib.compress(data)
+    return data
+
+def export_trace_ids(event_type, offset=0, limit=None, encoding="raw", after_trace_id=None, until_trace_id=None, buckets=256, bucket=None):
+    logger.info(f"GET request received for a binary export of {event_type} trace IDs")
+
+    if bucket:
+        trace_ids, _ = indexer.trace_ids_in_buckets(event_type, buckets, bucket, after_trace_id, until_trace_id)
+    else:
+        trace_ids, _ = indexer.trace_id_range(event_type, after_trace_id, until_trace_id)
+    stop = len(trace_ids) if limit is None else offset + limit
+    page = trace_ids[offset:stop]
+    data = encode_trace_ids(page, encoding)
+
+    logger.debug(f"Exported {len(page)} {event_type} trace IDs in {len(data)} bytes")
+    headers = page_headers(offset, len(page), len(trace_ids))
+    headers["X-Encoding"] = encoding
+    return Response(data, status=200, mimetype="application/octet-stream", headers=headers)
+
+def get_connection_stats():
+    logger.info("Fetching Kafka connection statistics")
+    return kafka_pool.stats(), 200
 
 app = connexion.FlaskApp(__name__, specification_dir="")
 app.add_api("./openapi.yml", base_path="/analyzer", strict_validation=True, validate_responses=True)
@@ -158,4 +191,7 @@ if "CORS_ALLOW_ALL" in os.environ and os.environ["CORS_ALLOW_ALL"] == "yes":
     allow_headers=["*"],
     )
 if __name__ == "__main__":
+    indexer.load_snapshot(SNAPSHOT_FILE)
+    indexer.start()
+    indexer.start_snapshots(SNAPSHOT_FILE, SNAPSHOT_INTERVAL)
     app.run(port=8100, host="0.0.0.0")
@@ -0,0 +1,443 @@
+import bisect
+import json
+import logging
+import mmap
+import os
+import random
+import struct
+import threading
+import time
+import uuid
+import zlib
+from array import array
+from pykafka.common import OffsetType
+from pykafka.exceptions import KafkaException
+
+logger = logging.getLogger("basicLogger")
+
+EVENT_TYPES = ("race_events", "telemetry_data")
+ID_FIELDS = {
+    "race_events": "event_id",
+    "telemetry_data": "telemetry_id"
+}
+
+# Snapshot layout, all little endian:
+#   header: magic, version, number of partitions
+#   per partition: partition id (i32), next offset to index (i64)
+#   per event type: count (u64), then the partitions (i32), offsets (i64),
+#   trace ids (i64) and ids (16 bytes each) arrays, then a JSON object of the
+#   ids that are not UUIDs, prefixed by its length (u64), then the sorted
+#   trace id cache: number of events it covers (u64), its length (u64), the
+#   sorted trace ids (i64) and their positions (i64)
+# Version 1 snapshots have no sorted cache and are still loaded.
+SNAPSHOT_MAGIC = b"ANIX"
+SNAPSHOT_VERSION = 2
+SNAPSHOT_HEADER = struct.Struct("<4sII")
+SNAPSHOT_PARTITION = struct.Struct("<iq")
+SNAPSHOT_COUNT = struct.Struct("<Q")
+UUID_SIZE = 16
+
+# Largest value an array('q') slot can hold
+MAX_TRACE_ID = 2 ** 63 - 1
+
+def parse_trace_id(value):
+    """The trace id as a number, or 0 when it is not a string of ASCII
+    digits. Storage leaves out the same trace ids, with REGEXP '^[0-9]+$'."""
+    if isinstance(value, int) and not isinstance(value, bool):
+        value = str(value)
+    if not isinstance(value, str) or not value.isascii() or not value.isdigit():
+        return 0
+    trace_id = int(value)
+    return trace_id if trace_id <= MAX_TRACE_ID else 0
+
+def merge_sorted(ids_a, positions_a, ids_b, positions_b):
+    """Merges two sorted trace id arrays, and their parallel position arrays,
+    into new arrays. Equal trace ids keep the ones from a first."""
+    merged = array('q')
+    merged_positions = array('q')
+    i = j = 0
+    while i < len(ids_a) and j < len(ids_b):
+        if ids_a[i] <= ids_b[j]:
+            merged.append(ids_a[i])
+            merged_positions.append(positions_a[i])
+            i += 1
+        else:
+            merged.append(ids_b[j])
+            merged_positions.append(positions_b[j])
+            j += 1
+    merged.extend(ids_a[i:])
+    merged_positions.extend(positions_a[i:])
+    merged.extend(ids_b[j:])
+    merged_positions.extend(positions_b[j:])
+    return merged, merged_positions
+
+class TopicIndexer:
+    """Tails the events topic in a background thread and records the
+    partition and offset of every message per event type, so that the n-th
+    event of a type can be fetched directly instead of scanning the topic."""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.lock = threading.Lock()
+        # Parallel arrays: the n-th event of a type is at
+        # (partitions[type][n], offsets[type][n])
+        self.partitions = {event_type: array('i') for event_type in EVENT_TYPES}
+        self.offsets = {event_type: array('q') for event_type in EVENT_TYPES}
+        # trace_ids[type][n] and the 16 byte UUID at ids[type][16 * n] belong
+        # to the same event. Ids that are not UUIDs are kept in odd_ids.
+        self.trace_ids = {event_type: array('q') for event_type in EVENT_TYPES}
+        self.ids = {event_type: bytearray() for event_type in EVENT_TYPES}
+        self.odd_ids = {event_type: {} for event_type in EVENT_TYPES}
+        # (number of trace ids included, sorted array of them, their
+        # positions in topic order) per type. Trace ids that could not be
+        # parsed are stored as 0 and left out of the sorted arrays.
+        self.sorted_cache = {event_type: (0, array('q'), array('q')) for event_type in EVENT_TYPES}
+        # Next offset to index for each partition
+        self.next_offsets = {}
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            consumer = None
+            topic, generation = self.pool.get_topic()
+            try:
+                consumer = self.make_consumer(topic)
+                for msg in consumer:
+                    if msg is not None:
+                        self.add(msg)
+            except KafkaException as e:
+                logger.error(f"Indexer lost its Kafka connection: {str(e)}")
+                if consumer is not None:
+                    self.pool.stop_consumer(consumer)
+                    consumer = None
+                time.sleep(random.randint(500, 1500) / 1000.0)
+                self.pool.reconnect(generation)
+            finally:
+                if consumer is not None:
+                    consumer.stop()
+
+    def make_consumer(self, topic):
+        consumer = self.pool.make_consumer(
+            topic,
+            reset_offset_on_start=True,
+            auto_offset_reset=OffsetType.EARLIEST
+        )
+        with self.lock:
+            resume_offsets = [
+                (topic.partitions[partition_id], offset - 1)
+                for partition_id, offset in self.next_offsets.items()
+            ]
+        if resume_offsets:
+            # pykafka takes the last consumed offset, hence the - 1
+            consumer.reset_offsets(resume_offsets)
+        return consumer
+
+    def add(self, msg):
+        event_type = None
+        try:
+            event = json.loads(msg.value.decode("utf-8"))
+            if event["type"] in self.offsets:
+                event_type = event["type"]
+                payload = event["payload"]
+                event_id = str(payload.get(ID_FIELDS[event_type]))
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            logger.warning(f"Indexer skipped message at offset {msg.offset}: {str(e)}")
+            event_type = None
+
+        if event_type is not None:
+            trace_id = parse_trace_id(payload.get("trace_id"))
+
+        with self.lock:
+            if event_type is not None:
+                index = len(self.offsets[event_type])
+                self.partitions[event_type].append(msg.partition_id)
+                self.offsets[event_type].append(msg.offset)
+                self.trace_ids[event_type].append(trace_id)
+                try:
+                    self.ids[event_type] += uuid.UUID(event_id).bytes
+                except ValueError:
+                    self.ids[event_type] += bytes(UUID_SIZE)
+                    self.odd_ids[event_type][index] = event_id
+            self.next_offsets[msg.partition_id] = msg.offset + 1
+
+    def event_id(self, event_type, index):
+        # Caller must hold the lock
+        odd_id = self.odd_ids[event_type].get(index)
+        if odd_id is not None:
+            return odd_id
+        start = index * UUID_SIZE
+        return str(uuid.UUID(bytes=bytes(self.ids[event_type][start:start + UUID_SIZE])))
+
+    def trace_id_pairs(self, event_type, start=0, stop=None):
+        """Returns the (event id, trace id) pairs of a type in topic order,
+        from position start up to, not including, stop."""
+        with self.lock:
+            trace_ids = self.trace_ids[event_type]
+            stop = len(trace_ids) if stop is None else min(stop, len(trace_ids))
+            return [
+                (self.event_id(event_type, index), str(trace_ids[index]))
+                for index in range(start, stop)
+            ]
+
+    def sorted_trace_ids(self, event_type):
+        """Returns the trace ids of a type as a sorted array, and a parallel
+        array with the topic order position of each one. The sorted copy is
+        cached, and saved with the snapshots, and only the ids indexed since
+        the last call are merged in."""
+        with self.lock:
+            cached_count, cached, cached_positions = self.sorted_cache[event_type]
+            tail = self.trace_ids[event_type][cached_count:]
+            count = cached_count + len(tail)
+        if not tail:
+            return cached, cached_positions
+
+        # Only the new ids are sorted, by their index in the tail
+        order = sorted((i for i in range(len(tail)) if tail[i] != 0), key=tail.__getitem__)
+        if order:
+            tail_ids = array('q', (tail[i] for i in order))
+            tail_positions = array('q', (cached_count + i for i in order))
+            # Trace ids from several receivers arrive almost sorted, so only
+            # the end of the cached order overlaps with the new ids and needs
+            # merging
+            start = bisect.bisect_right(cached, tail_ids[0])
+            merged_ids, merged_id_positions = merge_sorted(
+                cached[start:], cached_positions[start:], tail_ids, tail_positions
+            )
+            merged = cached[:start] + merged_ids
+            merged_positions = cached_positions[:start] + merged_id_positions
+        else:
+            merged, merged_positions = cached, cached_positions
+
+        with self.lock:
+            if self.sorted_cache[event_type][0] < count:
+                self.sorted_cache[event_type] = (count, merged, merged_positions)
+        return merged, merged_positions
+
+    def trace_id_range(self, event_type, after_trace_id=None, until_trace_id=None):
+        """Returns the sorted trace ids and their positions that are greater
+        than after_trace_id and at most until_trace_id."""
+        trace_ids, positions = self.sorted_trace_ids(event_type)
+        start = 0 if after_trace_id is None else bisect.bisect_right(trace_ids, after_trace_id)
+        stop = len(trace_ids) if until_trace_id is None else bisect.bisect_right(trace_ids, until_trace_id)
+        return trace_ids[start:stop], positions[start:stop]
+
+    def trace_id_pairs_at(self, event_type, positions):
+        """Returns the (event id, trace id) pairs at the given positions."""
+        with self.lock:
+            trace_ids = self.trace_ids[event_type]
+            return [(self.event_id(event_type, index), str(trace_ids[index])) for index in positions]
+
+    def trace_ids_in_buckets(self, event_type, buckets, bucket_ids, after_trace_id=None, until_trace_id=None):
+        """Like trace_id_range, but only keeps the trace ids whose bucket,
+        trace_id % buckets, is one of bucket_ids."""
+        trace_ids, positions = self.trace_id_range(event_type, after_trace_id, until_trace_id)
+        wanted = set(bucket_ids)
+        kept = [i for i, trace_id in enumerate(trace_ids) if trace_id % buckets in wanted]
+        return array('q', (trace_ids[i] for i in kept)), array('q', (positions[i] for i in kept))
+
+    def bucket_digests(self, event_type, buckets, after_trace_id=None, until_trace_id=None):
+        """Splits the trace ids in the range into buckets by trace_id % buckets
+        and returns the number of ids and the digest of each bucket. The
+        digest is the sum of the CRC32 of each trace id's decimal string,
+        modulo 2**32, so it does not depend on the order of the ids and
+        storage can compute the same value in SQL."""
+        trace_ids, _ = self.trace_id_range(event_type, after_trace_id, until_trace_id)
+        counts = [0] * buckets
+        digests = [0] * buckets
+        for trace_id in trace_ids:
+            bucket = trace_id % buckets
+            counts[bucket] += 1
+            digests[bucket] += zlib.crc32(str(trace_id).encode())
+        return counts, [digest & 0xFFFFFFFF for digest in digests]
+
+    def save_snapshot(self, path):
+        """Writes the index to path. The arrays are copied under the lock,
+        which is a memcpy, and written out after releasing it."""
+        with self.lock:
+            next_offsets = dict(self.next_offsets)
+            sections = [
+                (
+                    self.partitions[event_type][:],
+                    self.offsets[event_type][:],
+                    self.trace_ids[event_type][:],
+                    bytes(self.ids[event_type]),
+                    dict(self.odd_ids[event_type]),
+                    # The cached arrays are replaced, never modified
+                    self.sorted_cache[event_type]
+                )
+                for event_type in EVENT_TYPES
+            ]
+
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(next_offsets)))
+            for partition_id, offset in next_offsets.items():
+                f.write(SNAPSHOT_PARTITION.pack(partition_id, offset))
+            for partitions, offsets, trace_ids, ids, odd_ids, (sorted_count, sorted_ids, sorted_positions) in sections:
+                f.write(SNAPSHOT_COUNT.pack(len(offsets)))
+                f.write(partitions.tobytes())
+                f.write(offsets.tobytes())
+                f.write(trace_ids.tobytes())
+                f.write(ids)
+                odd_ids_json = json.dumps(odd_ids).encode("utf-8")
+                f.write(SNAPSHOT_COUNT.pack(len(odd_ids_json)))
+                f.write(odd_ids_json)
+                f.write(SNAPSHOT_COUNT.pack(sorted_count))
+                f.write(SNAPSHOT_COUNT.pack(len(sorted_ids)))
+                f.write(sorted_ids.tobytes())
+                f.write(sorted_positions.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        # Replace atomically so a crash never leaves a half written snapshot
+        os.replace(tmp_path, path)
+        logger.info(f"Saved index snapshot at offsets {next_offsets}")
+
+    def load_snapshot(self, path):
+        """Loads a snapshot written by save_snapshot. The indexer then only
+        replays the messages after the snapshot's offsets."""
+        if not os.path.exists(path):
+            logger.info("No index snapshot found, indexing the topic from the start")
+            return False
+
+        try:
+            with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                magic, version, partition_count = SNAPSHOT_HEADER.unpack_from(data, 0)
+                if magic != SNAPSHOT_MAGIC or version not in (1, SNAPSHOT_VERSION):
+                    logger.warning("Ignoring index snapshot with an unknown format")
+                    return False
+                position = SNAPSHOT_HEADER.size
+
+                next_offsets = {}
+                for _ in range(partition_count):
+                    partition_id, offset = SNAPSHOT_PARTITION.unpack_from(data, position)
+                    next_offsets[partition_id] = offset
+                    position += SNAPSHOT_PARTITION.size
+
+                sections = {}
+                for event_type in EVENT_TYPES:
+                    count, = SNAPSHOT_COUNT.unpack_from(data, position)
+                    position += SNAPSHOT_COUNT.size
+                    section = []
+                    for typecode, item_size in (('i', 4), ('q', 8), ('q', 8)):
+                        values = array(typecode)
+                        values.frombytes(data[position:position + count * item_size])
+                        section.append(values)
+                        position += count * item_size
+                    section.append(bytearray(data[position:position + count * UUID_SIZE]))
+                    position += count * UUID_SIZE
+                    odd_ids_size, = SNAPSHOT_COUNT.unpack_from(data, position)
+                    position += SNAPSHOT_COUNT.size
+                    odd_ids = json.loads(bytes(data[position:position + odd_ids_size]).decode("utf-8"))
+                    section.append({int(index): event_id for index, event_id in odd_ids.items()})
+                    position += odd_ids_size
+                    sorted_cache = (0, array('q'), array('q'))
+                    if version >= 2:
+                        sorted_count, sorted_length = struct.unpack_from("<QQ", data, position)
+                        position += 2 * SNAPSHOT_COUNT.size
+                        sorted_ids = array('q')
+                        sorted_ids.frombytes(data[position:position + sorted_length * 8])
+                        position += sorted_length * 8
+                        sorted_positions = array('q')
+                        sorted_positions.frombytes(data[position:position + sorted_length * 8])
+                        position += sorted_length * 8
+                        if sorted_count > count or len(sorted_positions) != sorted_length:
+                            raise ValueError("sorted trace id cache does not match the index")
+                        sorted_cache = (sorted_count, sorted_ids, sorted_positions)
+                    section.append(sorted_cache)
+                    sections[event_type] = section
+        except (OSError, ValueError, struct.error) as e:
+            logger.error(f"Ignoring unreadable index snapshot: {str(e)}")
+            return False
+
+        # A snapshot ahead of the topic means the topic was recreated
+        topic, _ = self.pool.get_topic()
+        for partition_id, offset in next_offsets.items():
+            partition = topic.partitions.get(partition_id)
+            if partition is None or offset > partition.latest_available_offset():
+                logger.warning("Ignoring index snapshot that is ahead of the topic")
+                return False
+
+        with self.lock:
+            self.next_offsets = next_offsets
+            for event_type, (partitions, offsets, trace_ids, ids, odd_ids, sorted_cache) in sections.items():
+                self.partitions[event_type] = partitions
+                self.offsets[event_type] = offsets
+                self.trace_ids[event_type] = trace_ids
+                self.ids[event_type] = ids
+                self.odd_ids[event_type] = odd_ids
+                self.sorted_cache[event_type] = sorted_cache
+        logger.info(f"Loaded index snapshot, resuming from offsets {next_offsets}")
+        return True
+
+    def start_snapshots(self, path, interval):
+        def save_periodically():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.save_snapshot(path)
+                except OSError as e:
+                    logger.error(f"Failed to save index snapshot: {str(e)}")
+
+        threading.Thread(target=save_periodically, daemon=True).start()
+
+    def counts(self):
+        with self.lock:
+            return {event_type: len(offsets) for event_type, offsets in self.offsets.items()}
+
+    def verify(self):
+        """Rescans the topic from the start and checks that the indexed
+        counts match it. Only messages that were already indexed when the
+        rescan started are compared, so live traffic does not cause false
+        mismatches. Returns (rescanned counts, indexed counts)."""
+        with self.lock:
+            limits = dict(self.next_offsets)
+            partitions = {event_type: array('i', p) for event_type, p in self.partitions.items()}
+            offsets = {event_type: array('q', o) for event_type, o in self.offsets.items()}
+
+        indexed = {
+            event_type: sum(1 for p, o in zip(partitions[event_type], offsets[event_type]) if o < limits.get(p, 0))
+            for event_type in EVENT_TYPES
+        }
+
+        rescanned = {event_type: 0 for event_type in EVENT_TYPES}
+        topic, _ = self.pool.get_topic()
+        consumer = self.pool.make_consumer(
+            topic,
+            reset_offset_on_start=True,
+            auto_offset_reset=OffsetType.EARLIEST,
+            consumer_timeout_ms=1000
+        )
+        try:
+            for msg in consumer:
+                if msg is None or msg.offset >= limits.get(msg.partition_id, 0):
+                    continue
+                event_type = json.loads(msg.value.decode("utf-8")).get("type")
+                if event_type in rescanned:
+                    rescanned[event_type] += 1
+        finally:
+            consumer.stop()
+        return rescanned, indexed
+
+    def lookup(self, event_type, index):
+        """Returns the (partition, offset) of the index-th event of a type, or
+        None if there is no such event."""
+        with self.lock:
+            if index < 0 or index >= len(self.offsets[event_type]):
+                return None
+            return self.partitions[event_type][index], self.offsets[event_type][index]
+
+    def fetch(self, partition_id, offset):
+        """Reads the single message stored at a partition and offset."""
+        with self.pool.partition_consumer(partition_id) as consumer:
+            partition = consumer.partitions[partition_id]
+            # pykafka takes the last consumed offset, but -1 would mean
+            # OffsetType.LATEST, so the first message is reached from EARLIEST
+            consumer.reset_offsets([(partition, offset - 1 if offset > 0 else OffsetType.EARLIEST)])
+            msg = consumer.consume(block=True)
+        if msg is None or msg.offset != offset:
+            return None
+        return json.loads(msg.value.decode("utf-8"))
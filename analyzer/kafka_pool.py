@@ -0,0 +1,130 @@
+import logging
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from pykafka import KafkaClient
+from pykafka.exceptions import KafkaException
+
+logger = logging.getLogger("basicLogger")
+
+class KafkaClientPool:
+    """Owns the analyzer's one KafkaClient and a pool of reusable
+    single-partition consumers, so request threads do not pay for metadata
+    discovery and consumer setup on every call."""
+
+    def __init__(self, hostname, topic, max_idle_consumers=4):
+        self.hostname = hostname
+        self.topic_name = topic
+        self.max_idle_consumers = max_idle_consumers
+        self.lock = threading.Lock()
+        self.client = None
+        self.topic = None
+        # Bumped on every reconnect so that a consumer from an old client is
+        # never put back into the pool
+        self.generation = 0
+        self.idle_consumers = {}
+        self.clients_created = 0
+        self.consumers_created = 0
+        self.connection_times = deque()
+        self.connect()
+
+    def connect(self):
+        """Creates the client, retrying the same way KafkaProducerWrapper does."""
+        while True:
+            logger.debug("Attempting to connect to Kafka...")
+            try:
+                client = KafkaClient(hosts=self.hostname)
+                topic = client.topics[str.encode(self.topic_name)]
+                break
+            except KafkaException as e:
+                logger.error(f"Error creating Kafka client: {str(e)}")
+                time.sleep(random.randint(500, 1500) / 1000.0)
+
+        with self.lock:
+            self.client = client
+            self.topic = topic
+            self.generation += 1
+            self.clients_created += 1
+            self.connection_times.append(time.monotonic())
+        logger.info("Kafka client created")
+
+    def reconnect(self, generation):
+        """Replaces the client after a broker error. Several threads may hit
+        the same error, only the first one reconnects."""
+        with self.lock:
+            if generation != self.generation:
+                return
+            stale_consumers = [consumer for consumers in self.idle_consumers.values() for consumer in consumers]
+            self.idle_consumers = {}
+        for consumer in stale_consumers:
+            self.stop_consumer(consumer)
+        self.connect()
+
+    def get_topic(self):
+        with self.lock:
+            return self.topic, self.generation
+
+    def make_consumer(self, topic, **kwargs):
+        consumer = topic.get_simple_consumer(**kwargs)
+        with self.lock:
+            self.consumers_created += 1
+            self.connection_times.append(time.monotonic())
+        return consumer
+
+    @contextmanager
+    def partition_consumer(self, partition_id):
+        """Checks out a consumer of a single partition for the calling thread."""
+        with self.lock:
+            topic = self.topic
+            generation = self.generation
+            idle = self.idle_consumers.get(partition_id)
+            consumer = idle.pop() if idle else None
+
+        if consumer is None:
+            consumer = self.make_consumer(
+                topic,
+                partitions=[topic.partitions[partition_id]],
+                consumer_timeout_ms=1000,
+                # Idle pooled consumers should not prefetch the whole partition
+                queued_max_messages=1
+            )
+
+        # Whatever the with body raises, the consumer either goes back to the
+        # pool or is stopped, so its fetch threads never leak
+        pooled = False
+        stopped = False
+        try:
+            yield consumer
+            with self.lock:
+                idle = self.idle_consumers.setdefault(partition_id, [])
+                if generation == self.generation and len(idle) < self.max_idle_consumers:
+                    idle.append(consumer)
+                    pooled = True
+        except KafkaException:
+            self.stop_consumer(consumer)
+            stopped = True
+            self.reconnect(generation)
+            raise
+        finally:
+            if not pooled and not stopped:
+                self.stop_consumer(consumer)
+
+    def stop_consumer(self, consumer):
+        try:
+            consumer.stop()
+        except KafkaException as e:
+            logger.debug(f"Error stopping consumer: {str(e)}")
+
+    def stats(self):
+        with self.lock:
+            cutoff = time.monotonic() - 60
+            while self.connection_times and self.connection_times[0] < cutoff:
+                self.connection_times.popleft()
+            return {
+                "clients_created": self.clients_created,
+                "consumers_created": self.consumers_created,
+                "connections_last_minute": len(self.connection_times),
+                "idle_consumers": sum(len(consumers) for consumers in self.idle_consumers.values())
+            }
@@ -1,17 +1,22 @@
 import connexion
 from connexion import NoContent
-import json
 import yaml
 import logging
 import logging.config
 import os
+import sqlite3
 import time
 from datetime import datetime
 import httpx
 from apscheduler.schedulers.background import BackgroundScheduler
 from connexion.middleware import MiddlewarePosition
 from starlette.middleware.cors import CORSMiddleware
-from pykafka import KafkaClient
+from pykafka.common import OffsetType
+from kafka_wrapper import KafkaProducerWrapper
+from detector import AnomalyDetector
+from rules import RuleSet, default_rules
+from rolling import RollingDetector
+from store import AnomalyStore
 
 # Set environment variable for logging
 os.environ["LOG_FILENAME"] = "/app/logs/anomaly_detector.log"
@@ -29,94 +34,74 @@ with open('/app/config/anomaly_detector/anomaly_config.yml', 'r') as f:
 
 # Define consistency check file path
 ANOMALY_FILE = app_config['datastore']['filename']
-client = KafkaClient(hosts=f"{app_config['events']['hostname']}:{app_config['events']['port']}")
-topic = client.topics[app_config['events']['topic'].encode()]
+ANOMALY_DATABASE = app_config['datastore'].get('database', os.path.join(os.path.dirname(ANOMALY_FILE), 'anomalies.db'))
+MAX_PAGE_SIZE = 1000
+BATCH = app_config.get('batch', {})
+ROLLING = app_config.get('rolling', {})
+
+store = AnomalyStore(ANOMALY_DATABASE)
+# Without committed offsets the group starts at the beginning of the topic,
+# so the events from before the first start are checked too
+kafka_wrapper = KafkaProducerWrapper(
+    hostname=f"{app_config['events']['hostname']}:{app_config['events']['port']}",
+    topic=app_config['events']['topic'],
+    consumer_group=app_config['events'].get('consumer_group', 'anomaly_group'),
+    consumer_timeout_ms=BATCH.get('max_ms', 1000),
+    offset_reset=OffsetType.EARLIEST
+)
+detector = AnomalyDetector(
+    kafka_wrapper,
+    store,
+    RuleSet(app_config.get('rules') or default_rules(MIN_SPEED, MAX_LAP_COUNT)),
+    rolling=RollingDetector.from_config(ROLLING) if ROLLING.get('enabled', True) else None,
+    max_batch_size=BATCH.get('max_size', 500),
+    max_batch_ms=BATCH.get('max_ms', 1000),
+    retry_backoff_ms=BATCH.get('retry_backoff_ms', 1000)
+)
 
 def update_anomalies():
-    logger.debug("Updating anomalies")
+    """Messages are checked continuously as they arrive, this only makes the
+    consumer check the messages it is holding and reports its status."""
+    logger.debug("Flushing the anomaly detector")
     start_time = time.perf_counter_ns()
-    
-    anomalies_to_save = {}
-    anomaly_payload = {
-            "event_id": "0",
-            "trace_id": "0",
-            "event_type": "None",
-            "anomaly_type": "None",
-            "description": "None" 
-    }
-    consumer = None 
-    try:
-        consumer = topic.get_simple_consumer(reset_offset_on_start=True, consumer_timeout_ms=1000)
-        anomaly_payload = {"anomalies_count": 0}
-        counter = 0
-        for msg in consumer:
-            msg_str = msg.value.decode("utf-8")
-            msg = json.loads(msg_str)
-            if msg["type"] == "telemetry_data" and msg["payload"]["min_speed"] < MIN_SPEED:
-                logger.debug(f"anomaly detected, {msg['payload']['min_speed']} is below {MIN_SPEED}")
-                anomaly_to_save = anomaly_payload
-                anomaly_to_save["event_id"] = msg["payload"]["event_id"]
-                anomaly_to_save["trace_id"] = msg["payload"]["trace_id"]
-                anomaly_to_save["event_type"] = msg["type"]
-                anomaly_to_save["anomaly_type"] = "Out of range speed telemetry"
-                anomaly_to_save["description"] = "Speed has been sent as negative"
-                anomalies_to_save[counter] = anomaly_to_save
-                counter += 1
-                
-            if msg["type"] == "race_event" and msg["payload"]["lap_number"] > MAX_LAP_COUNT:
-                logger.debug(f"anomaly detected, {msg['payload']['lap_number']} is above {MAX_LAP_COUNT}")
-                anomaly_to_save = anomaly_payload
-                anomaly_to_save["event_id"] = msg["payload"]["event_id"]
-                anomaly_to_save["trace_id"] = msg["payload"]["trace_id"]
-                anomaly_to_save["event_type"] = msg["type"]
-                anomaly_to_save["anomaly_type"] = "Out of range: lap count"
-                anomaly_to_save["description"] = "Lap count was sent as too high (over 78)"
-                anomalies_to_save[counter] = anomaly_to_save
-                counter += 1
-        anomaly_payload["anomalies_count"] = counter
-        end_time = time.perf_counter_ns()
-        total_time = (end_time - start_time) * 1000
-        logger.info(f"Update took {total_time} ms")
-        with open(ANOMALY_FILE, "w") as f:
-            json.dump(anomalies_to_save, f, indent=2)
-        return anomaly_payload, 200
-    except Exception as e:
-        logger.error(f"Error in update_anomalies: {e}")
-        return {"msg": "Error occurred while updating anomalies"}, 500
-    finally:
-        if consumer:
-            consumer.stop()
+    if not detector.flush(timeout=app_config.get('flush_timeout', 5)):
+        logger.warning("Anomaly detector did not flush in time")
+    status = detector.status()
+    logger.info(f"Flush took {(time.perf_counter_ns() - start_time) // 1_000_000} ms | {status}")
+    return status, 201
+
 
+# The API names of the event types and the types of the messages in Kafka
+EVENT_TYPES = {
+    "race_event": "race_events",
+    "telemetry_event": "telemetry_data"
+}
 
-def get_anomalies(event_type=None):
+def get_anomalies(event_type=None, car_number=None, start_timestamp=None, end_timestamp=None, after_id=0, limit=100):
     logger.debug("Getting anomalies..")
-    valid_types = ["race_event", "telemetry_event"]
-    try:
-        with open(ANOMALY_FILE, "r") as f:
-                payload_to_return = json.load(f)
-    except Exception:
-        return {"msg": "Error with opening the json"},404
-        
-    if event_type not in valid_types and event_type != None:
+    if event_type not in EVENT_TYPES and event_type != None:
         return {"msg":"Need to put a valid variable!"},400
+    limit = min(limit, MAX_PAGE_SIZE)
+    try:
+        payload_to_return = store.query(
+            event_type=EVENT_TYPES.get(event_type),
+            car_number=car_number,
+            start_timestamp=start_timestamp,
+            end_timestamp=end_timestamp,
+            after_id=after_id,
+            limit=limit
+        )
+    except sqlite3.Error as e:
+        logger.error(f"Error reading the anomaly datastore: {e}")
+        return {"msg": "Error with reading the datastore"},404
+
+    logger.debug(f"Anomalies retreived: {len(payload_to_return)} ")
     if len(payload_to_return) == 0:
-        logger.debug(f"Anomalies retreived: {len(payload_to_return)} ")
         return {"msg": "No anomalies found"},204
-    if event_type == "race_event":
-        for i in payload_to_return:
-            if i["event_type"] == "telemetry_event":
-                payload_to_return.pop(i)
-        logger.debug(f"Anomalies retreived: {len(payload_to_return)} ")
-        return payload_to_return, 200
-    elif event_type == "telemetry_event":
-        for i in payload_to_return:
-            if i["event_type"] == "race_event":
-                payload_to_return.pop(i)
-        logger.debug(f"Anomalies retreived: {len(payload_to_return)} ")
-        return payload_to_return, 200
-    else:
-        logger.debug(f"Anomalies retreived: {len(payload_to_return)} ")
-        return payload_to_return, 200
+    headers = {}
+    if len(payload_to_return) == limit:
+        headers["X-Next-After-Id"] = str(payload_to_return[-1]["id"])
+    return payload_to_return, 200, headers
     
 app = connexion.FlaskApp(__name__, specification_dir="")
 app.add_api("./openapi.yml", base_path="/anomaly_detector", strict_validation=True, validate_responses=True)
@@ -132,4 +117,5 @@ if "CORS_ALLOW_ALL" in os.environ and os.environ["CORS_ALLOW_ALL"] == "yes":
     )
 if __name__ == "__main__":
     logger.info("Starting on port 8300")
+    detector.start()
     app.run(port=8300, host="0.0.0.0")
\ No newline at end of file
@@ -0,0 +1,121 @@
+"""Benchmark for the anomaly rule engine on a backlog of encoded messages.
+
+Decodes and evaluates a synthetic backlog in micro-batches the way the
+detector does, and compares that with checking each decoded message one rule
+at a time in plain Python. The optional third argument repeats the rule set
+to show how both scale with the number of rules:
+
+    python3 bench_rules.py 1000000 500 10
+
+With the default five rules the batch path is no faster than the plain loop:
+for 200k messages both take under 0.2 s, in batches of 500 or of 5000, and
+the batches come out slightly slower. It pulls ahead as rules are added; with
+50 rules it takes about 0.3 s against 0.9 s. Decoding takes about 1.8 s
+either way, so for the default rules it is decoding, not rule checks, that
+bounds throughput.
+"""
+import json
+import random
+import sys
+import time
+import uuid
+from detector import decode_message
+from rules import OPERATORS, RuleSet, default_rules
+
+RULES = default_rules(0, 78) + [
+    {"event_type": "telemetry_data", "field": "rpm", "op": ">", "value": 15000},
+    {"event_type": "telemetry_data", "field": "fuel_level", "min": 0, "max": 110},
+    {"event_type": "telemetry_data", "field": "lap_number", "max": 78}
+]
+
+class Message:
+    def __init__(self, value, offset):
+        self.value = value
+        self.offset = offset
+
+# Share of values drawn outside the rule thresholds
+OUTLIER_RATE = 0.001
+
+def reading(low, high, outlier_low, outlier_high):
+    if random.random() < OUTLIER_RATE:
+        return random.choice((outlier_low, outlier_high))
+    return random.randint(low, high)
+
+def make_backlog(count):
+    messages = []
+    trace_id = time.time_ns()
+    for offset in range(count):
+        trace_id += random.randint(1, 1000)
+        if random.random() < 0.9:
+            payload = {
+                "telemetry_id": str(uuid.uuid4()),
+                "car_number": random.randint(1, 20),
+                "lap_number": reading(1, 78, 1, 90),
+                "speed": reading(80, 340, -5, 340),
+                "fuel_level": reading(0, 110, -1, 120),
+                "rpm": reading(4000, 15000, 4000, 16000),
+                "timestamp": int(time.time()),
+                "trace_id": str(trace_id)
+            }
+            event = {"type": "telemetry_data", "payload": payload}
+        else:
+            payload = {
+                "event_id": str(uuid.uuid4()),
+                "car_number": random.randint(1, 20),
+                "lap_number": reading(1, 78, 1, 90),
+                "event_type": "pit_stop",
+                "timestamp": int(time.time()),
+                "trace_id": str(trace_id)
+            }
+            event = {"type": "race_events", "payload": payload}
+        messages.append(Message(json.dumps(event).encode("utf-8"), offset))
+    return messages
+
+def check_one_by_one(rule_set, events):
+    found = 0
+    for event in events:
+        for rule in rule_set.by_type.get(event["type"], []):
+            value = event["payload"].get(rule.field)
+            if value is None:
+                continue
+            if rule.op is not None:
+                if OPERATORS[rule.op](value, rule.value):
+                    found += 1
+            elif (rule.min is not None and value < rule.min) or (rule.max is not None and value > rule.max):
+                found += 1
+    return found
+
+def rule_checks(rule_set, events):
+    return sum(len(rule_set.by_type.get(event["type"], [])) for event in events)
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    copies = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    rule_set = RuleSet(RULES * copies)
+
+    print(f"Building a backlog of {count} messages")
+    messages = make_backlog(count)
+
+    start = time.perf_counter()
+    events = [decode_message(msg) for msg in messages]
+    decode_seconds = time.perf_counter() - start
+    checks = rule_checks(rule_set, events)
+
+    start = time.perf_counter()
+    anomalies = 0
+    for offset in range(0, count, batch_size):
+        anomalies += len(rule_set.evaluate(events[offset:offset + batch_size]))
+    batched_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    baseline_anomalies = check_one_by_one(rule_set, events)
+    baseline_seconds = time.perf_counter() - start
+
+    print(f"{len(rule_set.rules)} rules, {checks} rule checks")
+    print(f"decode:              {decode_seconds:8.2f} s  {count / decode_seconds:12.0f} msg/s")
+    print(f"batches of {batch_size:<6}    {batched_seconds:8.2f} s  {checks / batched_seconds:12.0f} rules/s  {anomalies} anomalies")
+    print(f"one by one:          {baseline_seconds:8.2f} s  {checks / baseline_seconds:12.0f} rules/s  {baseline_anomalies} anomalies")
+
+if __name__ == "__main__":
+    main()
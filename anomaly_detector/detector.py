@@ -0,0 +1,183 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+from pykafka.exceptions import KafkaException
+from rules import ID_FIELDS
+
+logger = logging.getLogger("basicLogger")
+
+def decode_message(msg):
+    try:
+        event = json.loads(msg.value.decode("utf-8"))
+        if event["type"] not in ID_FIELDS:
+            logger.debug("Skipping message of unknown type %s", event["type"])
+            return None
+        if not isinstance(event["payload"], dict):
+            raise TypeError("payload is not an object")
+        return event
+    except (ValueError, KeyError, TypeError) as e:
+        logger.error("Skipping undecodable message at offset %s: %s", msg.offset, str(e))
+        return None
+
+class AnomalyDetector:
+    """Tails the events topic and checks every message once, shortly after
+    it arrives. Messages are checked in batches of up to max_batch_size
+    messages or max_batch_ms milliseconds. The anomalies of a batch are
+    appended to the store before the consumer offsets are committed, so a
+    restart resumes after the last stored batch (at-least-once)."""
+
+    def __init__(self, kafka_wrapper, store, rules, rolling=None, max_batch_size=500, max_batch_ms=1000,
+                 retry_backoff_ms=1000):
+        self.kafka_wrapper = kafka_wrapper
+        self.store = store
+        self.rules = rules
+        self.rolling = rolling
+        self.max_batch_size = max_batch_size
+        self.max_batch_ms = max_batch_ms
+        self.retry_backoff_ms = retry_backoff_ms
+        self.lock = threading.Lock()
+        self.flush_requested = threading.Event()
+        self.flushed = threading.Condition(self.lock)
+        self.batches = 0
+        self.messages_checked = 0
+        self.pending = 0
+        self.last_batch_time = None
+        self.last_event_timestamp = None
+
+    def start(self):
+        thread = threading.Thread(target=self.run, daemon=True)
+        thread.start()
+        return thread
+
+    def detect(self, events):
+        anomalies = self.rules.evaluate(events)
+        if self.rolling is not None:
+            anomalies.extend(self.rolling.evaluate(events))
+        return anomalies
+
+    def detect_batch(self, batch):
+        """Checks a batch, falling back to one event at a time when the batch
+        fails, so a bad event only skips itself."""
+        try:
+            return self.detect(batch)
+        except Exception as e:
+            logger.warning("Batch of %d could not be checked (%s), checking events one at a time", len(batch), str(e))
+        anomalies = []
+        for event in batch:
+            try:
+                anomalies.extend(self.detect([event]))
+            except Exception as e:
+                logger.error("Skipping %s with trace_id %s that could not be checked: %s",
+                             event["type"], event["payload"].get("trace_id"), str(e))
+        return anomalies
+
+    def store_anomalies(self, anomalies):
+        """Appends anomalies to the store, retrying until the database accepts
+        them. Only returns once every anomaly has either been stored or been
+        rejected on its own."""
+        while True:
+            try:
+                self.store.append(anomalies)
+                return
+            except sqlite3.OperationalError as e:
+                logger.error("Anomaly database unavailable while storing %d anomalies: %s", len(anomalies), str(e))
+            except Exception as e:
+                logger.warning("%d anomalies were rejected (%s), storing them one at a time", len(anomalies), str(e))
+                try:
+                    self.store_individually(anomalies)
+                    return
+                except sqlite3.OperationalError as e:
+                    logger.error("Anomaly database unavailable while storing anomalies one at a time: %s", str(e))
+            time.sleep(self.retry_backoff_ms / 1000.0)
+
+    def store_individually(self, anomalies):
+        for anomaly in anomalies:
+            try:
+                self.store.append([anomaly])
+            except sqlite3.OperationalError:
+                raise
+            except Exception as e:
+                logger.error("Failed to store anomaly %s for trace_id %s: %s",
+                             anomaly["anomaly_type"], anomaly["trace_id"], str(e))
+
+    def run(self):
+        batch = []
+        consumed = 0
+        deadline = None
+        while True:
+            try:
+                msg = self.kafka_wrapper.consumer.consume(block=True)
+            except KafkaException as e:
+                # The uncommitted messages are redelivered after reconnecting
+                logger.error("Error consuming messages: %s", str(e))
+                batch = []
+                consumed = 0
+                deadline = None
+                self.kafka_wrapper.reconnect()
+                continue
+
+            if msg is not None:
+                consumed += 1
+                event = decode_message(msg)
+                if event is not None:
+                    batch.append(event)
+                if deadline is None:
+                    deadline = time.monotonic() + self.max_batch_ms / 1000.0
+                with self.lock:
+                    self.pending = consumed
+
+            if consumed == 0:
+                self.notify_flushed()
+                continue
+            if consumed < self.max_batch_size and time.monotonic() < deadline and not self.flush_requested.is_set():
+                continue
+
+            start_time = time.monotonic()
+            anomalies = self.detect_batch(batch)
+            self.store_anomalies(anomalies)
+            try:
+                self.kafka_wrapper.consumer.commit_offsets()
+            except KafkaException as e:
+                logger.error("Failed to commit offsets, the batch will be checked again: %s", str(e))
+                self.kafka_wrapper.reconnect()
+            logger.info("Checked batch of %d messages in %d ms, found %d anomalies",
+                        consumed, int((time.monotonic() - start_time) * 1000), len(anomalies))
+
+            with self.lock:
+                self.batches += 1
+                self.messages_checked += consumed
+                self.pending = 0
+                self.last_batch_time = time.time()
+                if batch:
+                    self.last_event_timestamp = batch[-1]["payload"].get("timestamp")
+            self.notify_flushed()
+            batch = []
+            consumed = 0
+            deadline = None
+
+    def notify_flushed(self):
+        if self.flush_requested.is_set():
+            with self.flushed:
+                self.flush_requested.clear()
+                self.flushed.notify_all()
+
+    def flush(self, timeout):
+        """Asks the consumer thread to check its pending messages now and
+        waits up to timeout seconds for it to do so. Messages still in
+        Kafka are not waited for. Returns False on timeout."""
+        with self.flushed:
+            self.flush_requested.set()
+            return self.flushed.wait(timeout)
+
+    def status(self):
+        with self.lock:
+            return {
+                "anomalies_count": self.store.count,
+                "messages_checked": self.messages_checked,
+                "batches": self.batches,
+                "pending": self.pending,
+                "last_batch_time": self.last_batch_time,
+                "last_event_timestamp": self.last_event_timestamp
+            }
@@ -1,5 +1,3 @@
-# kafka_wrapper.py
-import json
 import logging
 import time
 import random
@@ -10,9 +8,16 @@ from pykafka.exceptions import KafkaException
 logger = logging.getLogger("basicLogger")
 
 class KafkaProducerWrapper:
-    def __init__(self, hostname, topic):
+    def __init__(self, hostname, topic, consumer_group=None, consumer_timeout_ms=-1, balanced=False, offset_reset=OffsetType.LATEST):
         self.hostname = hostname
         self.topic = topic
+        self.consumer_group = consumer_group
+        self.consumer_timeout_ms = consumer_timeout_ms
+        # Where a consumer group without committed offsets starts
+        self.offset_reset = offset_reset
+        # A balanced consumer joins the consumer group and is assigned a share
+        # of the topic's partitions, so several of them can consume in parallel
+        self.balanced = balanced
         self.client = None
         self.consumer = None
         self.producer = None
@@ -56,9 +61,22 @@ class KafkaProducerWrapper:
         
         try:
             topic = self.client.topics[str.encode(self.topic)]
+            if self.balanced:
+                self.consumer = topic.get_balanced_consumer(
+                    consumer_group=str.encode(self.consumer_group),
+                    managed=True,
+                    auto_commit_enable=False,
+                    consumer_timeout_ms=self.consumer_timeout_ms,
+                    reset_offset_on_start=False,
+                    auto_offset_reset=self.offset_reset
+                )
+                return True
             self.consumer = topic.get_simple_consumer(
+                consumer_group=str.encode(self.consumer_group) if self.consumer_group else None,
+                auto_commit_enable=False,
+                consumer_timeout_ms=self.consumer_timeout_ms,
                 reset_offset_on_start=False,
-                auto_offset_reset=OffsetType.LATEST
+                auto_offset_reset=self.offset_reset
             )
             return True
         except KafkaException as e:
@@ -90,6 +108,18 @@ class KafkaProducerWrapper:
             self.producer = None
             return False
         
+    def reconnect(self):
+        if self.consumer is not None and self.balanced:
+            # Leave the group so the partitions are reassigned right away
+            try:
+                self.consumer.stop()
+            except KafkaException:
+                pass
+        self.client = None
+        self.consumer = None
+        self.producer = None
+        self.connect()
+
     def messages(self):
         if self.consumer is None:
             self.connect()
@@ -0,0 +1,118 @@
+import logging
+import math
+from array import array
+from rules import ID_FIELDS
+
+logger = logging.getLogger("basicLogger")
+
+DEFAULT_FIELDS = ("speed", "rpm", "fuel_level")
+
+class RollingDetector:
+    """Flags telemetry that jumps away from the car's own recent behaviour.
+
+    Each car keeps an exponentially weighted mean and variance of every
+    field, updated in O(1) per message:
+
+        diff = x - mean
+        mean += alpha * diff
+        var = (1 - alpha) * (var + alpha * diff * diff)
+
+    A value is flagged when it is more than threshold standard deviations
+    from the mean before it was added, once the car has sent warmup values.
+    alpha sets the window: the weights halve about every 0.69 / alpha
+    messages. The state is three flat arrays with one slot per car and
+    field, so memory is fixed per car and max_cars bounds the total."""
+
+    def __init__(self, fields=DEFAULT_FIELDS, alpha=0.02, threshold=5.0, warmup=50, min_std=0.0, max_cars=256):
+        self.fields = tuple(fields)
+        self.alpha = alpha
+        self.threshold = threshold
+        self.warmup = warmup
+        self.min_std = min_std
+        self.max_cars = max_cars
+        self.slots = {}
+        self.means = array('d')
+        self.variances = array('d')
+        self.counts = array('q')
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            fields=config.get('fields', DEFAULT_FIELDS),
+            alpha=config.get('alpha', 0.02),
+            threshold=config.get('threshold', 5.0),
+            warmup=config.get('warmup', 50),
+            min_std=config.get('min_std', 0.0),
+            max_cars=config.get('max_cars', 256)
+        )
+
+    def slot(self, car_number):
+        slot = self.slots.get(car_number)
+        if slot is None:
+            if len(self.slots) >= self.max_cars:
+                return None
+            slot = len(self.slots) * len(self.fields)
+            self.slots[car_number] = slot
+            zeros = [0] * len(self.fields)
+            self.means.extend(zeros)
+            self.variances.extend(zeros)
+            self.counts.extend(zeros)
+            if len(self.slots) == self.max_cars:
+                logger.warning("Rolling detector is tracking max_cars=%d cars, new cars are not checked", self.max_cars)
+        return slot
+
+    def check(self, event):
+        """Updates the car's state with a telemetry event and returns the
+        anomalies in it."""
+        payload = event["payload"]
+        slot = self.slot(payload.get("car_number"))
+        if slot is None:
+            return []
+
+        anomalies = []
+        alpha = self.alpha
+        for offset, field in enumerate(self.fields):
+            value = payload.get(field)
+            if value is None:
+                continue
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                continue
+            if math.isnan(value):
+                continue
+            i = slot + offset
+            count = self.counts[i]
+            if count == 0:
+                self.means[i] = value
+                self.counts[i] = 1
+                continue
+
+            mean = self.means[i]
+            variance = self.variances[i]
+            diff = value - mean
+            std = max(math.sqrt(variance), self.min_std)
+            if count >= self.warmup and std > 0 and abs(diff) > self.threshold * std:
+                anomalies.append({
+                    "event_id": str(payload.get(ID_FIELDS[event["type"]])),
+                    "trace_id": str(payload.get("trace_id")),
+                    "event_type": event["type"],
+                    "car_number": payload.get("car_number"),
+                    "timestamp": payload.get("timestamp"),
+                    "anomaly_type": f"Sudden change: {field}",
+                    "description": f"Detected: {value:g}; {abs(diff) / std:.1f} standard deviations from car "
+                                   f"{payload.get('car_number')}'s recent mean of {mean:.1f}"
+                })
+
+            self.means[i] = mean + alpha * diff
+            self.variances[i] = (1 - alpha) * (variance + alpha * diff * diff)
+            self.counts[i] = count + 1
+        return anomalies
+
+    def evaluate(self, events):
+        anomalies = []
+        for event in events:
+            if event["type"] == "telemetry_data":
+                anomalies.extend(self.check(event))
+        return anomalies
+
@@ -0,0 +1,92 @@
+import logging
+import os
+import sqlite3
+import threading
+
+logger = logging.getLogger("basicLogger")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS anomalies (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    event_id TEXT NOT NULL,
+    trace_id TEXT NOT NULL,
+    event_type TEXT NOT NULL,
+    car_number INTEGER,
+    timestamp INTEGER,
+    anomaly_type TEXT NOT NULL,
+    description TEXT NOT NULL,
+    UNIQUE (trace_id, event_id, anomaly_type)
+);
+CREATE INDEX IF NOT EXISTS ix_anomalies_event_type ON anomalies (event_type, id);
+CREATE INDEX IF NOT EXISTS ix_anomalies_car_number ON anomalies (car_number, id);
+CREATE INDEX IF NOT EXISTS ix_anomalies_timestamp ON anomalies (timestamp);
+"""
+
+COLUMNS = ("id", "event_id", "trace_id", "event_type", "car_number", "timestamp", "anomaly_type", "description")
+
+class AnomalyStore:
+    """Anomaly datastore in SQLite. Anomalies are appended with an
+    autoincrement id that doubles as the pagination cursor, and indexed by
+    event type, car and timestamp so a filtered page only reads the rows it
+    returns. The unique key drops anomalies that are found again when a
+    batch is redelivered after a restart."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.local = threading.local()
+        os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+        connection = self.connection()
+        # WAL lets the API read while the consumer thread writes
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(SCHEMA)
+        self.lock = threading.Lock()
+        self.count = connection.execute("SELECT COUNT(*) FROM anomalies").fetchone()[0]
+
+    def connection(self):
+        # sqlite3 connections can only be used by the thread that made them
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.filename, timeout=10)
+            self.local.connection = connection
+        return connection
+
+    def append(self, anomalies):
+        if not anomalies:
+            return 0
+        connection = self.connection()
+        with connection:
+            inserted = connection.executemany(
+                "INSERT OR IGNORE INTO anomalies (event_id, trace_id, event_type, car_number, timestamp, anomaly_type, description) "
+                "VALUES (:event_id, :trace_id, :event_type, :car_number, :timestamp, :anomaly_type, :description)",
+                [{**anomaly, "car_number": anomaly.get("car_number"), "timestamp": anomaly.get("timestamp")}
+                 for anomaly in anomalies]
+            ).rowcount
+        if inserted < len(anomalies):
+            logger.debug("Skipped %d anomalies that were already stored", len(anomalies) - inserted)
+        with self.lock:
+            self.count += inserted
+        return inserted
+
+    def query(self, event_type=None, car_number=None, start_timestamp=None, end_timestamp=None, after_id=0, limit=100):
+        """Returns up to limit anomalies with an id greater than after_id that
+        match the filters, in the order they were found."""
+        conditions = ["id > ?"]
+        params = [after_id]
+        if event_type is not None:
+            conditions.append("event_type = ?")
+            params.append(event_type)
+        if car_number is not None:
+            conditions.append("car_number = ?")
+            params.append(car_number)
+        if start_timestamp is not None:
+            conditions.append("timestamp >= ?")
+            params.append(start_timestamp)
+        if end_timestamp is not None:
+            conditions.append("timestamp < ?")
+            params.append(end_timestamp)
+        params.append(limit)
+        rows = self.connection().execute(
+            f"SELECT {', '.join(COLUMNS)} FROM anomalies WHERE {' AND '.join(conditions)} ORDER BY id LIMIT ?",
+            params
+        ).fetchall()
+        return [{column: value for column, value in zip(COLUMNS, row) if value is not None} for row in rows]
@@ -6,8 +6,12 @@ import logging
 import logging.config
 import os
 import time
+import asyncio
+import threading
+import itertools
 from datetime import datetime
 import httpx
+from sorted_diff import DeltaDecoder, diff_streams
 from apscheduler.schedulers.background import BackgroundScheduler
 from connexion.middleware import MiddlewarePosition
 from starlette.middleware.cors import CORSMiddleware
@@ -27,6 +31,40 @@ with open('/app/config/consistency_check/consistency_config.yml', 'r') as f:
 
 # Define consistency check file path
 CONSISTENCY_FILE = app_config['datastore']['filename']
+WATERMARK_FILE = app_config['datastore'].get(
+    'watermark_filename',
+    os.path.join(os.path.dirname(CONSISTENCY_FILE), 'consistency_watermark.json'))
+
+# Incremental checks only reconcile trace IDs newer than the last watermark.
+# Trace IDs are nanosecond timestamps, so anything newer than the lag allowance
+# is left for a later run, since it may still be on its way to storage.
+# The watermark never moves past a trace ID that is still missing, so events
+# that arrive late are checked again until they show up on both sides
+INCREMENTAL = app_config.get('incremental', {})
+INCREMENTAL_ENABLED = INCREMENTAL.get('enabled', True)
+LAG_ALLOWANCE_NS = int(INCREMENTAL.get('lag_allowance', 30) * 1_000_000_000)
+
+# Both sides split trace IDs into buckets and digest each one, so only the
+# trace IDs of buckets whose digests differ have to be fetched and compared.
+# If more buckets than max_filtered_buckets differ, the whole range is fetched
+DIGEST = app_config.get('digest', {})
+DIGEST_BUCKETS = DIGEST.get('buckets', 256)
+MAX_FILTERED_BUCKETS = DIGEST.get('max_filtered_buckets', 64)
+
+# Only the first max_missing missing events of each kind are listed, all of
+# them are counted in missing_counts
+MAX_MISSING = app_config.get('diff', {}).get('max_missing', 100)
+# Bucket count used to look up the event IDs of the listed missing trace IDs
+RESOLVE_BUCKETS = 65536
+
+EVENT_TYPES = (
+    # event type, analyzer ID list, storage ID list, ID field
+    ("race_events", "race_trace_ids", "event_ids", "event_id"),
+    ("telemetry_data", "telemetry_trace_ids", "telemetry_ids", "telemetry_id")
+)
+
+# Scheduled and on demand checks share the watermark, so only one runs at a time
+check_lock = threading.Lock()
 
 
 def get_consistency_checks():
@@ -50,117 +88,233 @@ def get_consistency_checks():
         logger.error(f"Error retrieving consistency check results: {str(e)}")
         return {"message": f"Error: {str(e)}"}, 500
 
-def update_consistency_checks():
+# All upstream calls run on one event loop in a background thread, with one
+# shared AsyncClient so connections are reused across checks, whether a check
+# is started by the scheduler or by a request
+http_loop = asyncio.new_event_loop()
+threading.Thread(target=http_loop.run_forever, daemon=True).start()
+
+async def make_http_client():
+    limits = app_config.get('http', {})
+    return httpx.AsyncClient(limits=httpx.Limits(
+        max_connections=limits.get('max_connections', 20),
+        max_keepalive_connections=limits.get('max_keepalive_connections', 10)
+    ))
+
+http_client = asyncio.run_coroutine_threadsafe(make_http_client(), http_loop).result()
+
+def upstream_setting(name, key, default):
+    """Per endpoint override from the upstreams section, falling back to the
+    defaults in the http section."""
+    upstreams = app_config.get('upstreams', {})
+    return upstreams.get(name, {}).get(key, app_config.get('http', {}).get(key, default))
+
+async def fetch_upstream(name, url):
+    """GETs an upstream URL with its own timeout, retrying connection errors
+    and 5xx responses. Returns (name, response or None, elapsed ms)."""
+    timeout = upstream_setting(name, 'timeout', 10)
+    retries = upstream_setting(name, 'retries', 2)
+    backoff = upstream_setting(name, 'retry_backoff', 0.2)
+
+    start_time = time.perf_counter()
+    response = None
+    for attempt in range(retries + 1):
+        try:
+            response = await http_client.get(url, timeout=timeout)
+            if response.status_code < 500:
+                break
+            logger.warning(f"{name} returned {response.status_code} (attempt {attempt + 1})")
+        except httpx.HTTPError as e:
+            logger.warning(f"Request to {name} failed (attempt {attempt + 1}): {str(e)}")
+        if attempt < retries:
+            await asyncio.sleep(backoff * 2 ** attempt)
+    elapsed_ms = int((time.perf_counter() - start_time) * 1000)
+    return name, response, elapsed_ms
+
+async def fetch_all(urls):
+    return await asyncio.gather(*(fetch_upstream(name, url) for name, url in urls.items()))
+
+def fetch_upstreams(urls):
+    """Fetches every URL concurrently. Returns the responses and the time
+    each one took, keyed by upstream name."""
+    results = asyncio.run_coroutine_threadsafe(fetch_all(urls), http_loop).result()
+    responses = {name: response for name, response, _ in results}
+    timings = {name: elapsed_ms for name, _, elapsed_ms in results}
+    return responses, timings
+
+def load_watermark():
+    """Returns the trace ID up to which the last check reconciled, or None
+    if no check has completed yet."""
+    if not os.path.exists(WATERMARK_FILE):
+        return None
+    try:
+        with open(WATERMARK_FILE, "r") as f:
+            return int(json.load(f)["trace_id"])
+    except (ValueError, KeyError, TypeError) as e:
+        logger.warning(f"Ignoring unreadable watermark file: {str(e)}")
+        return None
+
+def save_watermark(trace_id):
+    os.makedirs(os.path.dirname(WATERMARK_FILE), exist_ok=True)
+    with open(WATERMARK_FILE, "w") as f:
+        json.dump({"trace_id": trace_id, "saved_at": int(time.time())}, f)
+
+def next_watermark(diffs, watermark, until):
+    """The watermark to save after a check: just below the oldest trace ID
+    still missing on either side, or until if nothing is missing. The diffs
+    list missing trace IDs in order, so the oldest one is always listed."""
+    missing = [trace_id for diff in diffs.values() for trace_id in itertools.chain(*diff.only)]
+    if missing:
+        return min(missing) - 1
+    if any(diff.totals[0] or diff.totals[1] for diff in diffs.values()):
+        # Missing trace IDs that are counted but not listed (max_missing: 0)
+        return watermark
+    return until
+
+def failed_upstreams(responses):
+    return [name for name, response in responses.items() if response is None or response.status_code != 200]
+
+def differing_buckets(first, second):
+    """Buckets whose count or digest differs between two digest responses."""
+    return [bucket for bucket in range(DIGEST_BUCKETS)
+            if first["counts"][bucket] != second["counts"][bucket]
+            or first["digests"][bucket] != second["digests"][bucket]]
+
+async def stream_export(name, url):
+    """Yields the trace IDs of a delta encoded export as arrays while it
+    downloads."""
+    decoder = DeltaDecoder()
+    async with http_client.stream("GET", url, timeout=upstream_setting(name, 'timeout', 10)) as response:
+        response.raise_for_status()
+        async for data in response.aiter_bytes():
+            for trace_ids in decoder.decode(data):
+                yield trace_ids
+
+async def diff_export(event_type, analyzer_url, storage_url):
+    start_time = time.perf_counter()
+    diff = await diff_streams(stream_export(f"analyzer_{event_type}_export", analyzer_url),
+                              stream_export(f"storage_{event_type}_export", storage_url),
+                              MAX_MISSING)
+    return event_type, diff, int((time.perf_counter() - start_time) * 1000)
+
+async def diff_all(exports):
+    return await asyncio.gather(*(diff_export(event_type, *urls) for event_type, urls in exports.items()))
+
+def diff_exports(exports):
+    """Streams the analyzer and storage exports of each event type and diffs
+    them. Returns the SortedDiff of each event type, whose only[0] holds the
+    trace IDs missing in storage and only[1] those missing in the queue, and
+    the time each diff took."""
+    results = asyncio.run_coroutine_threadsafe(diff_all(exports), http_loop).result()
+    diffs = {event_type: diff for event_type, diff, _ in results}
+    timings = {f"{event_type}_export_diff": elapsed_ms for event_type, _, elapsed_ms in results}
+    return diffs, timings
+
+def missing_entries(trace_ids, source, other, id_field, event_type):
+    """Entries for the trace IDs the diff found missing, with the event IDs
+    from the side that has them."""
+    wanted = set(trace_ids)
+    other_pairs = {(int(item["trace_id"]), item[id_field]) for item in other}
+    return [{"event_id": item[id_field], "trace_id": item["trace_id"], "type": event_type}
+            for item in source
+            if int(item["trace_id"]) in wanted and (int(item["trace_id"]), item[id_field]) not in other_pairs]
+
+def update_consistency_checks(full=False):
+    with check_lock:
+        return run_consistency_checks(full)
+
+def run_consistency_checks(full):
     logger.info("Starting consistency check between Kafka queue and storage database")
     start_time = time.time()
     
     try:
-        # Get counts from processing
-        processing_url = f"{app_config['endpoints']['processing']}/statistics"
-        logger.debug(f"Fetching processing statistics from: {processing_url}")
-        processing_response = httpx.get(processing_url)
-        
-        if processing_response.status_code != 200:
-            logger.error(f"Failed to get statistics from processing: {processing_response.status_code}")
-            return {"message": "Failed to get statistics from processing"}, 500
-        
-        processing_stats = processing_response.json()
-        
-        # Get counts and IDs from analyzer (Kafka)
-        analyzer_stats_url = f"{app_config['endpoints']['analyzer']}/stats"
-        analyzer_race_ids_url = f"{app_config['endpoints']['analyzer']}/race_trace_ids"
-        analyzer_telemetry_ids_url = f"{app_config['endpoints']['analyzer']}/telemetry_trace_ids"
-        
-        logger.debug(f"Fetching analyzer statistics from: {analyzer_stats_url}")
-        analyzer_stats_response = httpx.get(analyzer_stats_url)
-        if analyzer_stats_response.status_code == 200:
-            analyzer_stats = analyzer_stats_response.json()
-        else:
-            logger.error(f"Failed to fetch analyzer statistics: {analyzer_stats_response.status_code}")
-            return {"message": "Failed to fetch analyzer statistics"}, 500
-        
-        logger.debug(f"Fetching race trace IDs from: {analyzer_race_ids_url}")
-        analyzer_race_ids_response = httpx.get(analyzer_race_ids_url)
-        
-        logger.debug(f"Fetching telemetry trace IDs from: {analyzer_telemetry_ids_url}")
-        analyzer_telemetry_ids_response = httpx.get(analyzer_telemetry_ids_url)
-        
-        if (analyzer_stats_response.status_code != 200 or 
-            analyzer_race_ids_response.status_code != 200 or 
-            analyzer_telemetry_ids_response.status_code != 200):
-            logger.error(f"Failed to get data from analyzer: {analyzer_stats_response.status_code}, {analyzer_race_ids_response.status_code}, {analyzer_telemetry_ids_response.status_code}")
-            return {"message": "Failed to get data from analyzer"}, 500
-
-        # Handle Kafka trace ID responses safely
-        if analyzer_race_ids_response.status_code != 200 or analyzer_telemetry_ids_response.status_code != 200:
-            logger.error("Failed to fetch trace IDs from analyzer (Kafka)")
-            return {"message": "Failed to fetch trace IDs from Kafka"}, 500
-
-        race_trace_ids = analyzer_race_ids_response.json()
-        telemetry_trace_ids = analyzer_telemetry_ids_response.json()
-        
-        # Get counts and IDs from storage (database)
-        storage_record_count_url = f"{app_config['endpoints']['storage']}/record_count"
-        storage_race_ids_url = f"{app_config['endpoints']['storage']}/event_ids"
-        storage_telemetry_ids_url = f"{app_config['endpoints']['storage']}/telemetry_ids"
-        
-        storage_record_count_response = httpx.get(storage_record_count_url)
+        watermark = None if full or not INCREMENTAL_ENABLED else load_watermark()
+        until = time.time_ns() - LAG_ALLOWANCE_NS
+        trace_range = f"until_trace_id={until}"
+        if watermark is not None:
+            trace_range += f"&after_trace_id={watermark}"
+        mode = "full" if watermark is None else "incremental"
+        logger.info(f"Running {mode} check | after_trace_id={watermark} | until_trace_id={until}")
+
+        processing = app_config['endpoints']['processing']
+        analyzer = app_config['endpoints']['analyzer']
+        storage = app_config['endpoints']['storage']
+        digest_query = f"buckets={DIGEST_BUCKETS}&{trace_range}"
+        responses, timings = fetch_upstreams({
+            "processing_stats": f"{processing}/statistics",
+            "analyzer_stats": f"{analyzer}/stats",
+            "analyzer_race_events_digest": f"{analyzer}/trace_id_digest?event_type=race_events&{digest_query}",
+            "analyzer_telemetry_data_digest": f"{analyzer}/trace_id_digest?event_type=telemetry_data&{digest_query}",
+            "storage_record_count": f"{storage}/record_count",
+            "storage_race_events_digest": f"{storage}/trace_id_digest?event_type=race_events&{digest_query}",
+            "storage_telemetry_data_digest": f"{storage}/trace_id_digest?event_type=telemetry_data&{digest_query}"
+        })
+        failed = failed_upstreams(responses)
+        if failed:
+            logger.error(f"Failed to get data from: {', '.join(failed)}")
+            return {"message": f"Failed to get data from {', '.join(failed)}"}, 500
+
+        # Diff the sorted trace IDs of the buckets whose digests differ
+        exports = {}
+        differing = {}
+        for event_type, _, _, _ in EVENT_TYPES:
+            buckets = differing_buckets(responses[f"analyzer_{event_type}_digest"].json(),
+                                        responses[f"storage_{event_type}_digest"].json())
+            differing[event_type] = len(buckets)
+            if not buckets:
+                continue
+            query = f"event_type={event_type}&encoding=delta&{trace_range}"
+            if len(buckets) <= MAX_FILTERED_BUCKETS:
+                query += f"&buckets={DIGEST_BUCKETS}&bucket={','.join(map(str, buckets))}"
+            exports[event_type] = (f"{analyzer}/trace_id_export?{query}", f"{storage}/trace_id_export?{query}")
+        logger.info(f"Buckets with differing digests: {differing}")
+        diffs, diff_timings = diff_exports(exports)
+        timings.update(diff_timings)
+
+        # Look up the event IDs of the missing trace IDs that are reported.
+        # The ID lists are filtered on a much finer bucket than the digests,
+        # so little more than the missing events themselves is transferred
+        id_urls = {}
+        for event_type, analyzer_path, storage_path, _ in EVENT_TYPES:
+            diff = diffs.get(event_type)
+            if diff is None or not (diff.only[0] or diff.only[1]):
+                continue
+            buckets = sorted({trace_id % RESOLVE_BUCKETS for trace_id in itertools.chain(*diff.only)})
+            query = f"{trace_range}&buckets={RESOLVE_BUCKETS}&bucket={','.join(map(str, buckets))}"
+            id_urls[f"analyzer_{event_type}_ids"] = f"{analyzer}/{analyzer_path}?{query}"
+            id_urls[f"storage_{event_type}_ids"] = f"{storage}/{storage_path}?{query}"
+        if id_urls:
+            id_responses, id_timings = fetch_upstreams(id_urls)
+            responses.update(id_responses)
+            timings.update(id_timings)
+        logger.debug(f"Upstream timings (ms): {timings}")
+
+        failed = failed_upstreams(responses)
+        if failed:
+            logger.error(f"Failed to get data from: {', '.join(failed)}")
+            return {"message": f"Failed to get data from {', '.join(failed)}"}, 500
+
+        processing_stats = responses["processing_stats"].json()
+        analyzer_stats = responses["analyzer_stats"].json()
+        record_counts = responses["storage_record_count"].json()
 
-        storage_race_ids_response = httpx.get(storage_race_ids_url)
-        
-        storage_telemetry_ids_response = httpx.get(storage_telemetry_ids_url)
-        
-        if (storage_record_count_response.status_code != 200 or 
-            storage_race_ids_response.status_code != 200 or 
-            storage_telemetry_ids_response.status_code != 200):
-            return {"message": "Failed to get data from storage"}, 500
-        
-        record_counts = storage_record_count_response.json()
-        storage_race_ids = storage_race_ids_response.json()
-        storage_telemetry_ids = storage_telemetry_ids_response.json()
-        
-        # Compare trace IDs to find missing events
-        queue_race_trace_ids = {item["trace_id"]: item["event_id"] for item in race_trace_ids}
-        queue_telemetry_trace_ids = {item["trace_id"]: item["telemetry_id"] for item in telemetry_trace_ids}
-        
-        db_race_trace_ids = {item["trace_id"]: item["event_id"] for item in storage_race_ids}
-        db_telemetry_trace_ids = {item["trace_id"]: item["telemetry_id"] for item in storage_telemetry_ids}
-        
-        # Find events missing in database
         missing_in_db = []
-        for trace_id, event_id in queue_race_trace_ids.items():
-            if trace_id not in db_race_trace_ids:
-                missing_in_db.append({
-                    "event_id": event_id,
-                    "trace_id": trace_id,
-                    "type": "race_events"
-                })
-        
-        for trace_id, telemetry_id in queue_telemetry_trace_ids.items():
-            if trace_id not in db_telemetry_trace_ids:
-                missing_in_db.append({
-                    "event_id": telemetry_id,
-                    "trace_id": trace_id,
-                    "type": "telemetry_data"
-                })
-        
-        # Find events missing in queue
         missing_in_queue = []
-        for trace_id, event_id in db_race_trace_ids.items():
-            if trace_id not in queue_race_trace_ids:
-                missing_in_queue.append({
-                    "event_id": event_id,
-                    "trace_id": trace_id,
-                    "type": "race_events"
-                })
-        
-        for trace_id, telemetry_id in db_telemetry_trace_ids.items():
-            if trace_id not in queue_telemetry_trace_ids:
-                missing_in_queue.append({
-                    "event_id": telemetry_id,
-                    "trace_id": trace_id,
-                    "type": "telemetry_data"
-                })
+        missing_counts = {"not_in_db": 0, "not_in_queue": 0}
+        for event_type, _, _, id_field in EVENT_TYPES:
+            diff = diffs.get(event_type)
+            if diff is None:
+                continue
+            queue_ids = responses[f"analyzer_{event_type}_ids"].json() if f"analyzer_{event_type}_ids" in responses else []
+            db_ids = responses[f"storage_{event_type}_ids"].json() if f"storage_{event_type}_ids" in responses else []
+            missing_in_db += missing_entries(diff.only[0], queue_ids, db_ids, id_field, event_type)
+            missing_in_queue += missing_entries(diff.only[1], db_ids, queue_ids, id_field, event_type)
+            missing_counts["not_in_db"] += diff.totals[0]
+            missing_counts["not_in_queue"] += diff.totals[1]
+
+        missing_in_db = missing_in_db[:MAX_MISSING]
+        missing_in_queue = missing_in_queue[:MAX_MISSING]
+        new_watermark = next_watermark(diffs, watermark, until)
         
         # Prepare consistency check result
         consistency_check = {
@@ -180,7 +334,11 @@ def update_consistency_checks():
                 }
             },
             "not_in_db": missing_in_db,
-            "not_in_queue": missing_in_queue
+            "not_in_queue": missing_in_queue,
+            "missing_counts": missing_counts,
+            "upstream_timings_ms": timings,
+            "mode": mode,
+            "watermark": None if new_watermark is None else str(new_watermark)
         }
 
 
@@ -191,21 +349,30 @@ def update_consistency_checks():
         # Save consistency check result to file
         with open(CONSISTENCY_FILE, "w") as f:
             json.dump(consistency_check, f, indent=2)
+        if new_watermark is not None:
+            save_watermark(new_watermark)
         
         end_time = time.time()
         processing_time_ms = int((end_time - start_time) * 1000)
         
-        logger.info(f"Consistency checks completed | processing_time_ms={processing_time_ms} | missing_in_db={len(missing_in_db)} | missing_in_queue={len(missing_in_queue)}")
+        logger.info(f"Consistency checks completed | mode={mode} | processing_time_ms={processing_time_ms} | slowest_upstream_ms={max(timings.values())} | missing_in_db={missing_counts['not_in_db']} | missing_in_queue={missing_counts['not_in_queue']}")
         
-        return {"processing_time_ms": processing_time_ms}, 200
+        return {"processing_time_ms": processing_time_ms, "upstream_timings_ms": timings, "mode": mode}, 200
     except Exception as e:
         logger.error(f"Error performing consistency check: {str(e)}")
         return {"message": f"Error: {str(e)}"}, 500
 
+scheduled_runs = 0
+
 def run_scheduled_check():
-    """Run scheduled consistency check"""
+    """Run scheduled consistency check. Scheduled checks are incremental,
+    with a full check every incremental.full_every runs if that is set."""
+    global scheduled_runs
     logger.info("Running scheduled consistency check")
-    update_consistency_checks()
+    full_every = INCREMENTAL.get('full_every')
+    full = bool(full_every) and scheduled_runs % full_every == 0
+    scheduled_runs += 1
+    update_consistency_checks(full=full)
 
 def init_scheduler():
     """Initialize the scheduler for periodic consistency checks"""
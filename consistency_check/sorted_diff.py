@@ -0,0 +1,106 @@
+import itertools
+import sys
+import zlib
+from array import array
+
+# The analyzer and storage both export trace IDs as sorted int64 values,
+# delta encoded and zlib compressed. The exports are decoded a chunk at a
+# time and merged, so memory use depends on the chunk size and on how many
+# missing IDs are kept, not on how many trace IDs there are.
+
+class DeltaDecoder:
+    """Turns the chunks of a delta encoded export into arrays of trace IDs."""
+
+    def __init__(self):
+        self.decompressor = zlib.decompressobj()
+        self.pending = b""
+        self.previous = 0
+
+    def decode(self, data, max_bytes=1 << 20):
+        """Yields the trace IDs in data as arrays. Deltas compress very well,
+        so data is decompressed at most max_bytes at a time."""
+        while data:
+            self.pending += self.decompressor.decompress(data, max_bytes)
+            data = self.decompressor.unconsumed_tail
+            usable = len(self.pending) - len(self.pending) % 8
+            deltas = array('q')
+            deltas.frombytes(self.pending[:usable])
+            self.pending = self.pending[usable:]
+            if sys.byteorder == "big":
+                deltas.byteswap()
+            trace_ids = array('q', itertools.accumulate(deltas, initial=self.previous))[1:]
+            if trace_ids:
+                self.previous = trace_ids[-1]
+                yield trace_ids
+
+class SortedDiff:
+    """Merges two ascending trace ID streams and collects the IDs that only
+    one side has. A repeated ID is matched one for one, so an ID that is
+    twice on one side and once on the other is reported once. Every missing
+    ID is counted but only the first max_missing of each side are kept."""
+
+    def __init__(self, max_missing):
+        self.max_missing = max_missing
+        self.only = (array('q'), array('q'))
+        self.totals = [0, 0]
+
+    def add(self, side, trace_ids):
+        self.totals[side] += len(trace_ids)
+        room = self.max_missing - len(self.only[side])
+        if room > 0:
+            self.only[side].extend(trace_ids[:room])
+
+    def merge(self, first, i, second, j, first_done, second_done):
+        """Merges first[i:] with second[j:] until one runs out and returns
+        the new positions. Once a stream is done, the rest of the other
+        one's chunk is missing from it."""
+        first_len = len(first)
+        second_len = len(second)
+        while i < first_len and j < second_len:
+            a = first[i]
+            b = second[j]
+            if a == b:
+                i += 1
+                j += 1
+            elif a < b:
+                self.add(0, first[i:i + 1])
+                i += 1
+            else:
+                self.add(1, second[j:j + 1])
+                j += 1
+        if second_done and i < first_len:
+            self.add(0, first[i:])
+            i = first_len
+        if first_done and j < second_len:
+            self.add(1, second[j:])
+            j = second_len
+        return i, j
+
+async def next_chunk(stream):
+    try:
+        return await stream.__anext__()
+    except StopAsyncIteration:
+        return None
+
+async def diff_streams(first, second, max_missing):
+    """first and second are async iterators of ascending trace ID arrays.
+    Returns the SortedDiff, whose only[0] holds the IDs only in first and
+    only[1] the IDs only in second."""
+    diff = SortedDiff(max_missing)
+    chunks = [array('q'), array('q')]
+    positions = [0, 0]
+    done = [False, False]
+    streams = (first, second)
+    while True:
+        for side in (0, 1):
+            while not done[side] and positions[side] == len(chunks[side]):
+                chunk = await next_chunk(streams[side])
+                if chunk is None:
+                    done[side] = True
+                    chunks[side] = array('q')
+                else:
+                    chunks[side] = chunk
+                positions[side] = 0
+        if all(done) and positions[0] == len(chunks[0]) and positions[1] == len(chunks[1]):
+            return diff
+        positions[0], positions[1] = diff.merge(chunks[0], positions[0], chunks[1], positions[1], done[0], done[1])
@@ -0,0 +1,130 @@
+import math
+
+FIELDS = ("speed", "rpm", "fuel_level")
+
+class RunningStats:
+    """Count, sum, min, max, mean and variance of a stream of values,
+    updated in O(1) per value with Welford's algorithm."""
+
+    __slots__ = ("count", "total", "minimum", "maximum", "mean", "m2")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def variance(self):
+        # Sample variance, 0 until there are two values
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    def to_json(self):
+        variance = self.variance()
+        return {
+            "count": self.count,
+            "sum": self.total,
+            "min": self.minimum,
+            "max": self.maximum,
+            "mean": self.mean,
+            "variance": variance,
+            "std": math.sqrt(variance),
+            "m2": self.m2
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        stats = cls()
+        stats.count = data["count"]
+        stats.total = data["sum"]
+        stats.minimum = data["min"]
+        stats.maximum = data["max"]
+        stats.mean = data["mean"]
+        stats.m2 = data["m2"]
+        return stats
+
+def field_stats_to_json(field_stats):
+    return {field: stats.to_json() for field, stats in field_stats.items()}
+
+def field_stats_from_json(data):
+    return {field: RunningStats.from_json(stats) for field, stats in data.items()}
+
+class Aggregates:
+    """Running statistics of the telemetry fields overall, per car and per
+    lap of each car. Each event updates a fixed number of RunningStats, so
+    the cost per event is constant. Only the latest max_laps_per_car laps
+    of a car are kept, so memory grows with the number of cars only."""
+
+    def __init__(self, fields=FIELDS, max_laps_per_car=100):
+        self.fields = tuple(fields)
+        self.max_laps_per_car = max_laps_per_car
+        self.overall = {}
+        self.cars = {}
+
+    def add(self, telemetry):
+        car = self.cars.setdefault(str(telemetry.get("car_number")), {"overall": {}, "laps": {}})
+        lap = None
+        if telemetry.get("lap_number") is not None:
+            lap_key = str(telemetry["lap_number"])
+            lap = car["laps"].get(lap_key)
+            if lap is None:
+                lap = car["laps"][lap_key] = {}
+                if len(car["laps"]) > self.max_laps_per_car:
+                    del car["laps"][min(car["laps"], key=lap_number)]
+
+        for field in self.fields:
+            value = telemetry.get(field)
+            if value is None:
+                continue
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                continue
+            for field_stats in (self.overall, car["overall"], lap):
+                if field_stats is None:
+                    continue
+                stats = field_stats.get(field)
+                if stats is None:
+                    stats = field_stats[field] = RunningStats()
+                stats.add(value)
+
+    def to_json(self):
+        return {
+            "overall": field_stats_to_json(self.overall),
+            "cars": {
+                car_number: {
+                    "overall": field_stats_to_json(car["overall"]),
+                    "laps": {lap: field_stats_to_json(lap_stats) for lap, lap_stats in car["laps"].items()}
+                } for car_number, car in self.cars.items()
+            }
+        }
+
+    @classmethod
+    def from_json(cls, data, fields=FIELDS, max_laps_per_car=100):
+        aggregates = cls(fields, max_laps_per_car)
+        aggregates.overall = field_stats_from_json(data.get("overall", {}))
+        aggregates.cars = {
+            car_number: {
+                "overall": field_stats_from_json(car.get("overall", {})),
+                "laps": {lap: field_stats_from_json(lap_stats) for lap, lap_stats in car.get("laps", {}).items()}
+            } for car_number, car in data.get("cars", {}).items()
+        }
+        return aggregates
+
+def lap_number(key):
+    try:
+        return int(key)
+    except ValueError:
+        return 0
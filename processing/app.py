@@ -9,6 +9,11 @@ import yaml
 from datetime import datetime, timezone
 import httpx
 import time
+from threading import Thread
+from pykafka.common import OffsetType
+from pykafka.exceptions import KafkaException
+from kafka_wrapper import KafkaProducerWrapper
+from aggregates import Aggregates
 from connexion.middleware import MiddlewarePosition
 from starlette.middleware.cors import CORSMiddleware
 
@@ -29,6 +34,23 @@ STATISTICS_FILE = app_config["datastore"]["filename"]
 PROCESSING_INTERVAL = app_config["scheduler"]["interval"]
 RACE_EVENTS_URL = app_config["eventstores"]["race_events"]["url"]
 TELEMETRY_DATA_URL = app_config["eventstores"]["telemetry_data"]["url"]
+# "polling" fetches new rows from storage every PROCESSING_INTERVAL seconds,
+# "kafka" consumes the events topic directly
+PROCESSING_MODE = app_config.get("consumer", {}).get("mode", "polling")
+# Per-lap aggregates kept for each car, older laps are dropped
+MAX_LAPS_PER_CAR = app_config.get("aggregates", {}).get("max_laps_per_car", 100)
+
+kafka_wrapper = None
+if PROCESSING_MODE == "kafka":
+    # A new consumer group starts at the end of the topic by default, since
+    # the statistics file may already count the older events
+    kafka_wrapper = KafkaProducerWrapper(
+        hostname=f"{app_config['events']['hostname']}:{app_config['events']['port']}",
+        topic=app_config["events"]["topic"],
+        consumer_group=app_config["events"].get("consumer_group", "processing_group"),
+        consumer_timeout_ms=app_config.get("batch", {}).get("max_ms", 200),
+        offset_reset=OffsetType.EARLIEST if app_config["events"].get("offset_reset") == "earliest" else OffsetType.LATEST
+    )
 
 def get_statistics():
     logger.info("GET request received for statistics")
@@ -44,9 +66,7 @@ def get_statistics():
     logger.error("Statistics file does not exist")
     return {"message": "Statistics do not exist"}, 404
 
-def populate_stats():
-    logger.info("Periodic processing started")
-
+def load_stats():
     if os.path.exists(STATISTICS_FILE):
         with open(STATISTICS_FILE, "r") as f:
             stats = json.load(f)
@@ -61,6 +81,52 @@ def populate_stats():
 
     if "stat_type_counts" not in stats:
         stats["stat_type_counts"] = {}
+    stats["aggregates"] = Aggregates.from_json(stats.get("aggregates", {}), max_laps_per_car=MAX_LAPS_PER_CAR)
+    return stats
+
+def update_stats(stats, new_race_events, new_telemetry_data):
+    """Folds new events into the running statistics. Every telemetry entry
+    updates the overall, per-car and per-lap aggregates once, so the speed
+    statistics cover every event processed so far, not just this batch."""
+    stat_counts = stats["stat_type_counts"]
+    aggregates = stats["aggregates"]
+
+    stat_counts["race_events"] = stat_counts.get("race_events", 0) + len(new_race_events)
+    stat_counts["telemetry"] = stat_counts.get("telemetry", 0) + len(new_telemetry_data)
+
+    for telemetry in new_telemetry_data:
+        aggregates.add(telemetry)
+
+    speed = aggregates.overall.get("speed")
+    if speed is not None:
+        stats["max_speed"] = speed.maximum
+        stats["min_speed"] = speed.minimum
+        stats["avg_speed"] = speed.mean
+
+def save_stats(stats):
+    stats_to_save = {
+        "stat_type_counts": stats["stat_type_counts"],
+        "max_speed": stats["max_speed"],
+        "min_speed": stats["min_speed"],
+        "avg_speed": stats["avg_speed"],
+        "last_processed_timestamp": stats["last_processed_timestamp"],
+        "aggregates": stats["aggregates"].to_json()
+    }
+    if "kafka_offsets" in stats:
+        stats_to_save["kafka_offsets"] = stats["kafka_offsets"]
+
+    # Write to a temporary file and rename it over the old one, so a reader
+    # never sees a half written file
+    temp_file = f"{STATISTICS_FILE}.tmp"
+    with open(temp_file, "w") as f:
+        json.dump(stats_to_save, f, indent=2)
+    os.replace(temp_file, STATISTICS_FILE)
+    return stats_to_save
+
+def populate_stats():
+    logger.info("Periodic processing started")
+
+    stats = load_stats()
 
     end_timestamp = int(time.time())
     start_timestamp = stats.get("last_processed_timestamp", int(time.time()))
@@ -84,38 +150,87 @@ def populate_stats():
     logger.info(f"Retrieved {len(new_race_events)} new race events")
     logger.info(f"Retrieved {len(new_telemetry_data)} new telemetry data entries")
 
-    stat_counts = stats["stat_type_counts"]
-    speeds = []
+    update_stats(stats, new_race_events, new_telemetry_data)
+    stats["last_processed_timestamp"] = end_timestamp
+    stats_to_save = save_stats(stats)
 
-    for event in new_race_events:
-        stat_counts["race_events"] = stat_counts.get("race_events", 0) + 1
-    stat_counts["telemetry"] = stat_counts.get("telemetry", 0) + len(new_telemetry_data)
-    
-    for telemetry in new_telemetry_data:
-        if "speed" in telemetry:
-            speeds.append(telemetry["speed"])
+    logger.info(f"Processed {len(new_race_events)} race events and {len(new_telemetry_data)} telemetry entries.")
+    logger.debug(f"Updated statistics: {json.dumps(stats_to_save, indent=2)}")
+    logger.info("Periodic processing ended")
 
-    if speeds:
-        stats["max_speed"] = max(speeds)
-        stats["min_speed"] = min(speeds)
-        stats["avg_speed"] = sum(speeds) / len(speeds)
+def decode_message(msg):
+    try:
+        event = json.loads(msg.value.decode("utf-8"))
+        return event["type"], event["payload"]
+    except (ValueError, KeyError, TypeError) as e:
+        logger.error(f"Skipping undecodable message at offset {msg.offset}: {str(e)}")
+        return None, None
 
-    stats["last_processed_timestamp"] = end_timestamp
+def process_messages():
+    """Kafka mode: consumes the events topic directly and updates the
+    statistics a micro-batch at a time. The file is written before the
+    offsets are committed, and it records the last offset counted on each
+    partition, so messages redelivered after a crash are not counted twice."""
+    batch_config = app_config.get("batch", {})
+    max_batch_size = batch_config.get("max_size", 500)
+    max_batch_ms = batch_config.get("max_ms", 200)
 
-    stats_to_save = {
-        "stat_type_counts": stats["stat_type_counts"],
-        "max_speed": stats["max_speed"],
-        "min_speed": stats["min_speed"],
-        "avg_speed": stats["avg_speed"],
-        "last_processed_timestamp": stats["last_processed_timestamp"]
-    }
+    stats = load_stats()
+    offsets = {int(partition): offset for partition, offset in stats.get("kafka_offsets", {}).items()}
+    race_events = []
+    telemetry_data = []
+    consumed = 0
+    deadline = None
+    while True:
+        try:
+            msg = kafka_wrapper.consumer.consume(block=True)
+        except KafkaException as e:
+            # The uncommitted messages are redelivered after reconnecting
+            logger.error(f"Error consuming messages: {str(e)}")
+            stats = load_stats()
+            offsets = {int(partition): offset for partition, offset in stats.get("kafka_offsets", {}).items()}
+            race_events = []
+            telemetry_data = []
+            consumed = 0
+            deadline = None
+            kafka_wrapper.reconnect()
+            continue
 
-    with open(STATISTICS_FILE, "w") as f:
-        json.dump(stats_to_save, f, indent=2)
+        if msg is not None and msg.offset > offsets.get(msg.partition_id, -1):
+            offsets[msg.partition_id] = msg.offset
+            consumed += 1
+            event_type, payload = decode_message(msg)
+            if event_type == "race_events":
+                race_events.append(payload)
+            elif event_type == "telemetry_data":
+                telemetry_data.append(payload)
+            if deadline is None:
+                deadline = time.monotonic() + max_batch_ms / 1000.0
 
-    logger.info(f"Processed {len(new_race_events)} race events and {len(new_telemetry_data)} telemetry entries.")
-    logger.debug(f"Updated statistics: {json.dumps(stats_to_save, indent=2)}")
-    logger.info("Periodic processing ended")
+        if consumed == 0:
+            continue
+        if consumed < max_batch_size and time.monotonic() < deadline:
+            continue
+
+        update_stats(stats, race_events, telemetry_data)
+        stats["last_processed_timestamp"] = int(time.time())
+        stats["kafka_offsets"] = {str(partition): offset for partition, offset in offsets.items()}
+        save_stats(stats)
+        try:
+            kafka_wrapper.consumer.commit_offsets()
+        except KafkaException as e:
+            logger.error(f"Failed to commit offsets, the batch will be redelivered and skipped: {str(e)}")
+            kafka_wrapper.reconnect()
+        logger.debug(f"Processed batch of {len(race_events)} race events and {len(telemetry_data)} telemetry entries")
+        race_events = []
+        telemetry_data = []
+        consumed = 0
+        deadline = None
+
+def setup_kafka_thread():
+    t1 = Thread(target=process_messages)
+    t1.daemon = True
+    t1.start()
     
 def init_scheduler():
     sched = BackgroundScheduler(daemon=True)
@@ -134,5 +249,8 @@ if "CORS_ALLOW_ALL" in os.environ and os.environ["CORS_ALLOW_ALL"] == "yes":
     allow_headers=["*"],
     )
 if __name__ == "__main__":
-    init_scheduler()
+    if PROCESSING_MODE == "kafka":
+        setup_kafka_thread()
+    else:
+        init_scheduler()
     app.run(port=8091, host="0.0.0.0")
@@ -9,9 +9,15 @@ import logging.config
 from pykafka import KafkaClient
 import json
 import os
+import atexit
+import threading
+from jsonschema import Draft4Validator, FormatChecker
+from pykafka.exceptions import ProducerQueueFullError
+from connexion.datastructures import MediaTypeDict
 from connexion.middleware import MiddlewarePosition
+from connexion.validators import VALIDATOR_MAP, AbstractRequestBodyValidator
 from starlette.middleware.cors import CORSMiddleware
-from kafka_wrapper import KafkaProducerWrapper
+from kafka_wrapper import KafkaProducerWrapper, DeliveryUnknown
 
 os.environ["LOG_FILENAME"] = "/app/logs/receiver.log"
 with open('/app/config/log_config.yml', 'r') as f:
@@ -24,12 +30,27 @@ with open('/app/config/receiver/receiver_config.yml', 'r') as f:
 
 kafka_producer = KafkaProducerWrapper(
     hostname=f"{config['events']['hostname']}:{config['events']['port']}",
-    topic=config['events']['topic']
+    topic=config['events']['topic'],
+    producer_config=config.get('producer', {}),
+    partitions=config['events'].get('partitions'),
+    replication_factor=config['events'].get('replication_factor', 1)
 )
+atexit.register(kafka_producer.stop)
 
-def log_event(event_type, event_data):
+trace_id_lock = threading.Lock()
+last_trace_id = 0
+
+def next_trace_id():
+    """time.time_ns() based trace id that never repeats within this process,
+    even when a bulk request builds many events in the same clock tick."""
+    global last_trace_id
+    with trace_id_lock:
+        last_trace_id = max(time.time_ns(), last_trace_id + 1)
+        return str(last_trace_id)
+
+def build_event_message(event_type, event_data):
     timestamp = int(time.time())
-    trace_id = str(time.time_ns())
+    trace_id = next_trace_id()
 
     if event_type == "race_events":
         event_entry = {
@@ -52,16 +73,32 @@ def log_event(event_type, event_data):
             "trace_id": trace_id
         }
     else:
-        logger.error("Unknown event type: %s", event_type)
-        return 400
+        return None
 
-    msg = {
+    return {
         "type": event_type,
         "datetime": datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
         "payload": event_entry
     }
+
+def partition_key(msg):
+    # Every event of a car lands on the same partition, so consumers can work
+    # on partitions in parallel and still see each car's events in order
+    return str(msg["payload"]["car_number"]).encode('utf-8')
+
+def log_event(event_type, event_data):
+    msg = build_event_message(event_type, event_data)
+    if msg is None:
+        logger.error("Unknown event type: %s", event_type)
+        return 400
+
+    trace_id = msg["payload"]["trace_id"]
     msg_str= json.dumps(msg)
-    kafka_producer.producer.produce(msg_str.encode('utf-8'))
+    try:
+        kafka_producer.produce(msg_str.encode('utf-8'), partition_key=partition_key(msg))
+    except ProducerQueueFullError:
+        logger.warning("Kafka producer queue is full, rejecting %s with a trace id of %s", event_type, trace_id)
+        return 503
     logger.info("Produced event %s with a trace id of %s", event_type, trace_id)
     return 201
 
@@ -74,8 +111,105 @@ def submit_telemetry_data(body):
     status_code = log_event("telemetry_data", body)
     return NoContent, status_code
 
+def load_payload_validators():
+    """Build validators for bulk items from the same request schemas that the
+    single event endpoints are validated against."""
+    with open('openapi.yml', 'r') as f:
+        spec = yaml.safe_load(f)
+    validators = {}
+    for event_type in ("race_events", "telemetry_data"):
+        schema = spec['paths'][f'/{event_type}']['post']['requestBody']['content']['application/json']['schema']
+        validators[event_type] = Draft4Validator(schema, format_checker=FormatChecker())
+    return validators
+
+payload_validators = load_payload_validators()
+MAX_BULK_ITEMS = config.get('bulk', {}).get('max_items', 5000)
+
+def parse_bulk_body(body):
+    """Returns a list of (item, error) pairs from either a JSON array or an
+    NDJSON document."""
+    if isinstance(body, list):
+        return [(item, None) for item in body]
+
+    if isinstance(body, bytes):
+        body = body.decode('utf-8')
+    items = []
+    for line_number, line in enumerate(body.splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            items.append((json.loads(line), None))
+        except ValueError as e:
+            items.append((None, f"Invalid JSON on line {line_number}: {str(e)}"))
+    return items
+
+def validate_bulk_item(item):
+    if not isinstance(item, dict):
+        return "Item must be an object"
+    event_type = item.get("type")
+    if event_type not in payload_validators:
+        return f"Unknown event type: {event_type}"
+    error = next(payload_validators[event_type].iter_errors(item.get("payload")), None)
+    if error is not None:
+        return error.message
+    return None
+
+def submit_bulk_events(body):
+    items = parse_bulk_body(body)
+    if len(items) > MAX_BULK_ITEMS:
+        return {"message": f"A bulk request can contain at most {MAX_BULK_ITEMS} items"}, 413
+
+    results = []
+    messages = []
+    produced_results = []
+    for index, (item, error) in enumerate(items):
+        if error is None:
+            error = validate_bulk_item(item)
+        if error is not None:
+            results.append({"index": index, "status": 400, "error": error})
+            continue
+
+        msg = build_event_message(item["type"], item["payload"])
+        result = {"index": index, "status": 201, "trace_id": msg["payload"]["trace_id"]}
+        results.append(result)
+        produced_results.append(result)
+        messages.append((json.dumps(msg).encode('utf-8'), partition_key(msg)))
+
+    if messages:
+        for result, exc in zip(produced_results, kafka_producer.produce_batch(messages)):
+            if isinstance(exc, DeliveryUnknown):
+                # The event keeps its trace_id and may still reach Kafka, a
+                # resend would store it twice under a new trace_id
+                result["status"] = 202
+                result["error"] = str(exc)
+            elif exc is not None:
+                result["status"] = 503
+                result["error"] = f"Failed to produce to Kafka: {str(exc)}"
+
+    accepted = sum(1 for result in results if result["status"] == 201)
+    unconfirmed = sum(1 for result in results if result["status"] == 202)
+    logger.info("Bulk request produced %d of %d events, %d unconfirmed", accepted, len(results), unconfirmed)
+    status_code = 201 if accepted == len(results) else 207
+    return {
+        "accepted": accepted,
+        "unconfirmed": unconfirmed,
+        "rejected": len(results) - accepted - unconfirmed,
+        "results": results
+    }, status_code
+
+class NDJSONRequestBodyValidator(AbstractRequestBodyValidator):
+    """Connexion validates any */*json body, application/x-ndjson included,
+    as one JSON document. NDJSON bulk bodies are parsed and validated line
+    by line in submit_bulk_events instead."""
+
+# Only the body validators are replaced, so the update must keep the others
+validator_map = {
+    "body": MediaTypeDict({**VALIDATOR_MAP["body"], "application/x-ndjson": NDJSONRequestBodyValidator})
+}
+
 app = connexion.FlaskApp(__name__, specification_dir='')
-app.add_api('./openapi.yml', base_path="/receiver", strict_validation=True, validate_responses=True)
+app.add_api('./openapi.yml', base_path="/receiver", strict_validation=True, validate_responses=True,
+            validator_map=validator_map)
 if "CORS_ALLOW_ALL" in os.environ and os.environ["CORS_ALLOW_ALL"] == "yes":    
     app.add_middleware(
     CORSMiddleware,
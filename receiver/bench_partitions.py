@@ -0,0 +1,102 @@
+"""Throughput benchmark for car-keyed partitioning of the events topic.
+
+For each partition count it creates a scratch topic, produces the same
+car-keyed telemetry load through KafkaProducerWrapper, then consumes it with
+one process per partition (as the storage consumer workers do) and reports
+messages per second for both sides:
+
+    python3 bench_partitions.py kafka:9092 200000 1 2 4 8
+"""
+import json
+import multiprocessing
+import random
+import sys
+import time
+import uuid
+from pykafka import KafkaClient
+from kafka_wrapper import KafkaProducerWrapper
+
+CARS = 20
+
+def make_messages(count):
+    messages = []
+    for i in range(count):
+        car_number = random.randint(1, CARS)
+        msg = {
+            "type": "telemetry_data",
+            "payload": {
+                "telemetry_id": str(uuid.uuid4()),
+                "car_number": car_number,
+                "lap_number": random.randint(1, 78),
+                "speed": random.randint(80, 340),
+                "fuel_level": random.randint(0, 110),
+                "rpm": random.randint(4000, 15000),
+                "timestamp": int(time.time()),
+                "trace_id": str(time.time_ns())
+            }
+        }
+        messages.append((json.dumps(msg).encode('utf-8'), str(car_number).encode('utf-8')))
+    return messages
+
+def consume_partition(hostname, topic_name, partition_id, expected, results):
+    client = KafkaClient(hosts=hostname)
+    topic = client.topics[str.encode(topic_name)]
+    consumer = topic.get_simple_consumer(
+        partitions=[topic.partitions[partition_id]],
+        reset_offset_on_start=True,
+        consumer_timeout_ms=5000
+    )
+    count = 0
+    for msg in consumer:
+        json.loads(msg.value.decode('utf-8'))
+        count += 1
+        if count == expected:
+            break
+    results[partition_id] = count
+
+def run(hostname, partitions, messages):
+    topic_name = f"bench_partitions_{partitions}_{int(time.time())}"
+    wrapper = KafkaProducerWrapper(
+        hostname=hostname,
+        topic=topic_name,
+        producer_config={"mode": "async", "max_batch_size": 1000},
+        partitions=partitions
+    )
+
+    start = time.perf_counter()
+    for offset in range(0, len(messages), 5000):
+        wrapper.produce_batch(messages[offset:offset + 5000])
+    produce_rate = len(messages) / (time.perf_counter() - start)
+    wrapper.stop()
+
+    topic = wrapper.client.topics[str.encode(topic_name)]
+    expected = {
+        partition_id: partition.latest_available_offset() - partition.earliest_available_offset()
+        for partition_id, partition in topic.partitions.items()
+    }
+    results = multiprocessing.Manager().dict()
+    processes = [
+        multiprocessing.Process(target=consume_partition, args=(hostname, topic_name, partition_id, count, results))
+        for partition_id, count in expected.items() if count
+    ]
+    start = time.perf_counter()
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    consume_rate = sum(results.values()) / (time.perf_counter() - start)
+    return produce_rate, consume_rate
+
+def main(hostname, count, partition_counts):
+    messages = make_messages(count)
+    print(f"{'partitions':>10}{'produce msg/s':>16}{'consume msg/s':>16}")
+    for partitions in partition_counts:
+        produce_rate, consume_rate = run(hostname, partitions, messages)
+        print(f"{partitions:>10}{produce_rate:>16.0f}{consume_rate:>16.0f}")
+
+if __name__ == "__main__":
+    main(
+        sys.argv[1],
+        int(sys.argv[2]) if len(sys.argv) > 2 else 200000,
+        [int(arg) for arg in sys.argv[3:]] or [1, 2, 4, 8]
+    )
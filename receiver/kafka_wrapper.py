@@ -3,19 +3,50 @@ import json
 import logging
 import time
 import random
+import threading
+import zlib
+from queue import Empty
 from pykafka import KafkaClient
 from pykafka.common import OffsetType
-from pykafka.exceptions import KafkaException
+from pykafka.exceptions import KafkaException, ProducerQueueFullError
+from pykafka.partitioners import HashingPartitioner, RandomPartitioner
+from pykafka.protocol import CreateTopicRequest
 
 logger = logging.getLogger("basicLogger")
 
+def stable_hash(key):
+    # Python's hash() of bytes is randomised per process, so replicas would
+    # disagree on the partition of a car. CRC32 is the same everywhere.
+    return zlib.crc32(key)
+
+PARTITIONERS = {
+    "hashing": HashingPartitioner(hash_func=stable_hash),
+    "random": RandomPartitioner()
+}
+
+class DeliveryUnknown(Exception):
+    """No delivery report arrived in time. The message is still queued in
+    the producer and may yet be delivered, so it must not be resent blindly."""
+
 class KafkaProducerWrapper:
-    def __init__(self, hostname, topic):
+    def __init__(self, hostname, topic, producer_config=None, partitions=None, replication_factor=1):
         self.hostname = hostname
         self.topic = topic
+        # producer_config keys: mode ("sync" or "async"), partitioner
+        # ("hashing" or "random"), linger_ms, max_batch_size,
+        # max_queued_messages, block_on_queue_full, batch_timeout_ms
+        self.producer_config = producer_config or {}
+        # When set, the topic is created with this many partitions if it
+        # does not exist yet
+        self.partitions = partitions
+        self.replication_factor = replication_factor
         self.client = None
         self.consumer = None
         self.producer = None
+        self.batch_producer = None
+        self.delivered_count = 0
+        self.failed_count = 0
+        self.report_lock = threading.Lock()
         self.connect()
 
     def connect(self):
@@ -36,6 +67,8 @@ class KafkaProducerWrapper:
         try:
             self.client = KafkaClient(hosts=self.hostname)
             logger.info("Kafka client created")
+            if self.partitions:
+                self.ensure_topic()
             return True
         except KafkaException as e:
             msg = f"Error creating Kafka client: {str(e)}"
@@ -43,8 +76,28 @@ class KafkaProducerWrapper:
             self.client = None
             self.consumer = None
             self.producer = None
+            self.batch_producer = None
             return False
         
+    def ensure_topic(self):
+        """Creates the topic with the configured number of partitions. Must run
+        before the topic is first looked up, since a lookup lets the broker
+        auto-create it with its default partition count."""
+        request = CreateTopicRequest(str.encode(self.topic), self.partitions, self.replication_factor, [], [])
+        # CreateTopics has to reach the controller, try each broker in turn
+        for broker in self.client.brokers.values():
+            try:
+                broker.create_topics([request], timeout=10000)
+                logger.info("Created topic %s with %d partitions", self.topic, self.partitions)
+                break
+            except KafkaException as e:
+                logger.debug("Broker %s did not create topic %s: %s", broker.id, self.topic, repr(e))
+
+        self.client.update_cluster()
+        partition_count = len(self.client.topics[str.encode(self.topic)].partitions)
+        if partition_count < self.partitions:
+            logger.warning("Topic %s has %d partitions, %d were requested", self.topic, partition_count, self.partitions)
+
     def make_consumer(self):
         if self.consumer is not None:
             return True
@@ -67,6 +120,7 @@ class KafkaProducerWrapper:
             self.consumer = None
             self.client = None
             self.producer = None
+            self.batch_producer = None
             return False
         
     def make_producer(self):
@@ -80,7 +134,15 @@ class KafkaProducerWrapper:
         
         try:
             topic = self.client.topics[str.encode(self.topic)]
-            self.producer = topic.get_sync_producer()
+            if self.is_async():
+                self.producer = self.make_async_producer(topic)
+                self.batch_producer = self.producer
+                logger.info("Kafka async producer created")
+            else:
+                self.producer = topic.get_sync_producer(partitioner=self.get_partitioner())
+                # Bulk requests always go through an async producer so that a
+                # whole batch shares one round trip to the broker
+                self.batch_producer = self.make_async_producer(topic)
             return True
         except KafkaException as e:
             msg = f"Error creating Kafka producer: {str(e)}"
@@ -88,8 +150,103 @@ class KafkaProducerWrapper:
             self.consumer = None
             self.client = None
             self.producer = None
+            self.batch_producer = None
             return False
         
+    def make_async_producer(self, topic):
+        return topic.get_producer(
+            sync=False,
+            partitioner=self.get_partitioner(),
+            linger_ms=self.producer_config.get("linger_ms", 5),
+            min_queued_messages=self.producer_config.get("max_batch_size", 500),
+            max_queued_messages=self.producer_config.get("max_queued_messages", 10000),
+            block_on_queue_full=self.producer_config.get("block_on_queue_full", False),
+            delivery_reports=True
+        )
+
+    def get_partitioner(self):
+        return PARTITIONERS[self.producer_config.get("partitioner", "hashing")]
+
+    def is_async(self):
+        return self.producer_config.get("mode", "sync") == "async"
+
+    def produce(self, message, partition_key=None):
+        """Produce a message. In async mode this only enqueues it and then
+        drains whatever delivery reports are ready for the calling thread."""
+        if self.producer is None:
+            self.connect()
+
+        self.producer.produce(message, partition_key=partition_key)
+        if self.is_async():
+            self.drain_delivery_reports()
+
+    def produce_batch(self, messages):
+        """Produce a list of (message, partition_key) pairs as one batch and
+        wait for their delivery reports. Returns one entry per message: None
+        if it was delivered, DeliveryUnknown if its report did not arrive
+        within batch_timeout_ms, otherwise the exception explaining why it
+        was not delivered."""
+        if self.batch_producer is None:
+            self.connect()
+
+        results = [None] * len(messages)
+        pending = {}
+        for index, (message, partition_key) in enumerate(messages):
+            try:
+                produced = self.batch_producer.produce(message, partition_key=partition_key)
+            except ProducerQueueFullError as e:
+                results[index] = e
+                continue
+            # keep a reference to the message so its id() stays unique
+            pending[id(produced)] = (index, produced)
+
+        timeout_s = self.producer_config.get("batch_timeout_ms", 10000) / 1000.0
+        deadline = time.monotonic() + timeout_s
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                msg, exc = self.batch_producer.get_delivery_report(block=True, timeout=remaining)
+            except Empty:
+                break
+            self.record_delivery_report(exc)
+            entry = pending.pop(id(msg), None)
+            if entry is not None:
+                results[entry[0]] = exc
+
+        for index, _ in pending.values():
+            results[index] = DeliveryUnknown(f"No delivery report within {timeout_s:g} s, the event may still be delivered")
+        return results
+
+    def drain_delivery_reports(self):
+        # pykafka keeps delivery reports in a per-thread queue, so they can
+        # only be collected from the thread that produced the messages
+        while True:
+            try:
+                msg, exc = self.producer.get_delivery_report(block=False)
+            except Empty:
+                return
+            self.record_delivery_report(exc)
+
+    def record_delivery_report(self, exc):
+        with self.report_lock:
+            if exc is None:
+                self.delivered_count += 1
+                return
+            self.failed_count += 1
+            failed_count = self.failed_count
+        logger.error("Failed to deliver message to Kafka: %s (%d failures so far)", exc, failed_count)
+
+    def stop(self):
+        """Flush any queued messages and stop the producers."""
+        if self.batch_producer is not None and self.batch_producer is not self.producer:
+            self.batch_producer.stop()
+        if self.producer is not None:
+            self.producer.stop()
+            if self.is_async():
+                self.drain_delivery_reports()
+
     def messages(self):
         if self.consumer is None:
             self.connect()
@@ -104,4 +261,5 @@ class KafkaProducerWrapper:
                 self.client = None
                 self.consumer = None
                 self.producer = None
+                self.batch_producer = None
                 self.connect()
\ No newline at end of file
@@ -3,20 +3,30 @@ from connexion import NoContent
 from db_class import TelemetryData, RaceEvents
 from datetime import datetime, timezone
 import functools
-from db import make_session
-from sqlalchemy import select, func
+from db import make_session, pool_stats
+from sqlalchemy import select, func, cast
+from sqlalchemy.dialects.mysql import BIGINT
 import yaml
 import logging
 import logging.config
 from dateutil import parser
 from pykafka import KafkaClient
 import json
+import operator
+import sys
+import zlib
+from array import array
 from pykafka.common import OffsetType
 from threading import Thread
 import os
+from connexion.datastructures import MediaTypeDict
 from connexion.middleware import MiddlewarePosition
+from connexion.validators import VALIDATOR_MAP, AbstractResponseBodyValidator
 from starlette.middleware.cors import CORSMiddleware
+from flask import Response, stream_with_context
 from kafka_wrapper import KafkaProducerWrapper
+import batch_writer
+import counters
 
 os.environ["LOG_FILENAME"] = "/app/logs/storage.log"
 
@@ -31,27 +41,21 @@ with open('/app/config/storage/storage_config.yml', 'r') as f:
 
 kafka_producer = KafkaProducerWrapper(
     hostname=f"{config['events']['hostname']}:{config['events']['port']}",
-    topic=config['events']['topic']
+    topic=config['events']['topic'],
+    consumer_group=config['events'].get('consumer_group', 'storage_group'),
+    consumer_timeout_ms=config.get('batch', {}).get('max_ms', 200)
 )
 
-def process_messages():
-
-    for msg in kafka_producer.consumer:
-        msg_str = msg.value.decode('utf-8')
-        msg = json.loads(msg_str)
-        logger.info("Message: %s", msg)
+STREAM_BATCH_SIZE = config.get('stream', {}).get('batch_size', 1000)
 
-        payload = msg['payload']
-        try:
-            if msg["type"] == "telemetry_data":
-                submit_telemetry_data(payload)
-            elif msg["type"] == "race_events":
-                submit_race_events(payload)
-            logger.info("Successfully processed %s with trace_id %s", msg["type"], payload.get("trace_id"))
-        except Exception as e:
-            logger.error("Failed to process %s: %s", msg["type"], str(e))
-            continue  # don't crash the loop
-        kafka_producer.consumer.commit_offsets()
+def process_messages():
+    batch_config = config.get('batch', {})
+    batch_writer.run(
+        kafka_producer,
+        max_batch_size=batch_config.get('max_size', 500),
+        max_batch_ms=batch_config.get('max_ms', 200),
+        retry_backoff_ms=batch_config.get('retry_backoff_ms', 1000)
+    )
 
 
 def setup_kafka_thread():
@@ -72,87 +76,127 @@ def use_db_session(func):
 # filepath: /c:/Users/xetro/OneDrive - BCIT/Term 4/Microservices/Week 6/storage/app.py
 @use_db_session
 def submit_race_events(session, body):
-    event = RaceEvents(
-        event_id=body['event_id'],
-        car_number=body['car_number'],
-        lap_number=body['lap_number'],
-        event_type=body['event_type'],
-        timestamp=int(body['timestamp']),  
-        trace_id=body['trace_id'] 
-    )
-    session.add(event)
+    inserted = batch_writer.insert_new_rows(session, "race_events", [batch_writer.race_event_row(body)])
+    counters.increment(session, {"race_events": inserted})
     session.commit()
-    session.close()
-    logger.debug("Stored event %s with a trace id of %s", event.event_type, event.trace_id)
+    if inserted:
+        logger.debug("Stored event %s with a trace id of %s", body['event_type'], body['trace_id'])
+    else:
+        logger.debug("Event with a trace id of %s was already stored", body['trace_id'])
     return NoContent, 201
 
 @use_db_session
 def submit_telemetry_data(session, body):
-    telemetry = TelemetryData(
-        telemetry_id=body['telemetry_id'],
-        car_number=body['car_number'],
-        lap_number=body['lap_number'],
-        speed=body['speed'],
-        fuel_level=body['fuel_level'],
-        rpm=body['rpm'],
-        timestamp=int(body['timestamp']), 
-        trace_id=body['trace_id']
-    )
-    session.add(telemetry)
+    inserted = batch_writer.insert_new_rows(session, "telemetry_data", [batch_writer.telemetry_row(body)])
+    counters.increment(session, {"telemetry_data": inserted})
     session.commit()
-    session.close()
-    logger.debug("Stored event telemetry_data with a trace id of %s", telemetry.trace_id)
+    if inserted:
+        logger.debug("Stored event telemetry_data with a trace id of %s", body['trace_id'])
+    else:
+        logger.debug("Telemetry data with a trace id of %s was already stored", body['trace_id'])
     return NoContent, 201
    
 
-@use_db_session
-def get_race_events(session, start_timestamp, end_timestamp):
-    start_dt = int(start_timestamp) 
-    end_dt = int(end_timestamp)  
-    statement = select(RaceEvents).where(RaceEvents.timestamp >= start_dt).where(RaceEvents.timestamp < end_dt)
-    results = [result.to_json() for result in session.execute(statement).scalars()]
-    
-    logger.info("Retrieved %d race events within the time range.", len(results))
-    return results, 200
+def range_statement(model, start_timestamp, end_timestamp, after_id, limit):
+    # Keyset pagination on the primary key: the next page starts after the
+    # last id of the previous one instead of skipping over an OFFSET
+    statement = select(model) \
+        .where(model.timestamp >= int(start_timestamp)) \
+        .where(model.timestamp < int(end_timestamp)) \
+        .where(model.id > after_id) \
+        .order_by(model.id)
+    if limit is not None:
+        statement = statement.limit(limit)
+    return statement
+
+def stream_events(statement):
+    """Yields rows as NDJSON lines straight from a server side cursor, so
+    memory use does not depend on how many rows the range contains."""
+    session = make_session()
+    try:
+        result = session.execute(statement.execution_options(yield_per=STREAM_BATCH_SIZE))
+        for event in result.scalars():
+            yield json.dumps(event.to_json()) + "\n"
+    finally:
+        session.close()
 
 @use_db_session
-def get_telemetry_data(session, start_timestamp, end_timestamp):
-    start_dt = int(start_timestamp) 
-    end_dt = int(end_timestamp) 
-    statement = select(TelemetryData).where(TelemetryData.timestamp >= start_dt).where(TelemetryData.timestamp < end_dt)
-    results = [result.to_json() for result in session.execute(statement).scalars()]
-    
-    logger.debug("Retrieved %d telemetry events within the time range.", len(results))
-    return results, 200
+def query_events(session, statement):
+    return [result.to_json() for result in session.execute(statement).scalars()]
+
+def get_events(model, start_timestamp, end_timestamp, after_id, limit, stream):
+    statement = range_statement(model, start_timestamp, end_timestamp, after_id, limit)
+    if stream:
+        logger.info("Streaming %s within the time range.", model.__tablename__)
+        return Response(stream_with_context(stream_events(statement)), status=200, mimetype="application/x-ndjson")
+
+    results = query_events(statement)
+    logger.info("Retrieved %d %s within the time range.", len(results), model.__tablename__)
+    # The operation also declares application/x-ndjson, so the JSON response
+    # has to name its content type
+    headers = {"Content-Type": "application/json"}
+    if limit is not None and len(results) == limit:
+        headers["X-Next-After-Id"] = str(results[-1]["id"])
+    return results, 200, headers
+
+def get_race_events(start_timestamp, end_timestamp, after_id=0, limit=None, stream=False):
+    return get_events(RaceEvents, start_timestamp, end_timestamp, after_id, limit, stream)
+
+def get_telemetry_data(start_timestamp, end_timestamp, after_id=0, limit=None, stream=False):
+    return get_events(TelemetryData, start_timestamp, end_timestamp, after_id, limit, stream)
 
 @use_db_session
 def get_record_count(session):
     """Get count of records in each table"""
     logger.info("GET request received for record count")
     
-    # Count race events
-    race_events_count = session.query(func.count(RaceEvents.event_id)).scalar()
-    
-    # Count telemetry data
-    telemetry_data_count = session.query(func.count(TelemetryData.telemetry_id)).scalar()
-    
-    result = {
-        "race_events": race_events_count,
-        "telemetry_data": telemetry_data_count
-    }
+    # Read from the maintained counters instead of counting the tables,
+    # run counters.py to rebuild them from a real count
+    result = counters.read_counts(session)
     
     logger.debug(f"Record count: {result}")
     logger.info("GET request for record count completed")
     
     return result, 200
 
+def trace_id_string(trace_id):
+    # trace_id is stored as a string of time.time_ns(), which has 19 digits,
+    # so zero padded strings compare in the same order as the numbers and the
+    # unique key on trace_id can serve the range
+    return str(trace_id).zfill(19)
+
+def trace_id_number(model):
+    return cast(model.trace_id, BIGINT(unsigned=True))
+
+def trace_id_range(statement, model, after_trace_id, until_trace_id):
+    # Trace ids that are not numbers are left out, as in the analyzer's index,
+    # so they cannot make the digests of the two sides differ
+    statement = statement.where(model.trace_id.regexp_match("^[0-9]+$"))
+    if after_trace_id is not None:
+        statement = statement.where(model.trace_id > trace_id_string(after_trace_id))
+    if until_trace_id is not None:
+        statement = statement.where(model.trace_id <= trace_id_string(until_trace_id))
+    return statement
+
+def trace_id_buckets(statement, model, buckets, bucket):
+    if not bucket:
+        return statement
+    return statement.where(func.mod(trace_id_number(model), buckets).in_(bucket))
+
+def get_ids(session, event_type, after_trace_id, until_trace_id, buckets, bucket):
+    model = batch_writer.MODELS[event_type]
+    id_field = batch_writer.ID_FIELDS[event_type]
+    statement = select(getattr(model, id_field), model.trace_id).order_by(model.trace_id)
+    statement = trace_id_range(statement, model, after_trace_id, until_trace_id)
+    statement = trace_id_buckets(statement, model, buckets, bucket)
+    return [{id_field: result[0], "trace_id": result[1]} for result in session.execute(statement)]
+
 @use_db_session
-def get_event_ids(session):
+def get_event_ids(session, after_trace_id=None, until_trace_id=None, buckets=256, bucket=None):
     """Get list of race event IDs and trace IDs"""
     logger.info("GET request received for race event IDs")
     
-    statement = select(RaceEvents.event_id, RaceEvents.trace_id)
-    results = [{"event_id": result[0], "trace_id": result[1]} for result in session.execute(statement)]
+    results = get_ids(session, "race_events", after_trace_id, until_trace_id, buckets, bucket)
     
     logger.debug(f"Retrieved {len(results)} race event IDs")
     logger.info("GET request for race event IDs completed")
@@ -160,20 +204,97 @@ def get_event_ids(session):
     return results, 200
 
 @use_db_session
-def get_telemetry_ids(session):
+def get_telemetry_ids(session, after_trace_id=None, until_trace_id=None, buckets=256, bucket=None):
     """Get list of telemetry IDs and trace IDs"""
     logger.info("GET request received for telemetry IDs")
     
-    statement = select(TelemetryData.telemetry_id, TelemetryData.trace_id)
-    results = [{"telemetry_id": result[0], "trace_id": result[1]} for result in session.execute(statement)]
+    results = get_ids(session, "telemetry_data", after_trace_id, until_trace_id, buckets, bucket)
     
     logger.debug(f"Retrieved {len(results)} telemetry IDs")
     logger.info("GET request for telemetry IDs completed")
     
     return results, 200
 
+@use_db_session
+def get_trace_id_digest(session, event_type, buckets=256, after_trace_id=None, until_trace_id=None):
+    """Get the count and digest of each trace ID bucket"""
+    logger.info(f"GET request received for the {event_type} trace ID digest")
+
+    # Same buckets and digests as the analyzer: bucket is trace_id % buckets,
+    # digest is the sum of CRC32 over the decimal trace ids, modulo 2**32
+    model = batch_writer.MODELS[event_type]
+    bucket_column = func.mod(trace_id_number(model), buckets)
+    statement = select(bucket_column, func.count(), func.sum(func.crc32(trace_id_number(model)))).group_by(bucket_column)
+    statement = trace_id_range(statement, model, after_trace_id, until_trace_id)
+
+    counts = [0] * buckets
+    digests = [0] * buckets
+    for bucket, count, digest in session.execute(statement):
+        counts[int(bucket)] = count
+        digests[int(bucket)] = int(digest) & 0xFFFFFFFF
+
+    logger.debug(f"Computed {buckets} bucket digests over {sum(counts)} {event_type} trace IDs")
+    return {"buckets": buckets, "counts": counts, "digests": digests}, 200
+
+def stream_trace_ids(statement, encoding):
+    """Yields the trace ids as little endian int64 values, the same formats
+    as the analyzer's export. delta: the difference to the previous id
+    instead of the id, zlib compressed. Rows come from a server side cursor
+    and are encoded a batch at a time."""
+    session = make_session()
+    compressor = zlib.compressobj() if encoding == "delta" else None
+    previous = 0
+    try:
+        result = session.execute(statement.execution_options(yield_per=STREAM_BATCH_SIZE))
+        for rows in result.scalars().partitions():
+            trace_ids = array('q', map(int, rows))
+            if compressor:
+                last = trace_ids[-1]
+                trace_ids = array('q', map(operator.sub, trace_ids, array('q', [previous]) + trace_ids[:-1]))
+                previous = last
+            if sys.byteorder == "big":
+                trace_ids.byteswap()
+            data = trace_ids.tobytes()
+            yield compressor.compress(data) if compressor else data
+        if compressor:
+            yield compressor.flush()
+    finally:
+        session.close()
+
+def export_trace_ids(event_type, encoding="raw", after_trace_id=None, until_trace_id=None, buckets=256, bucket=None):
+    """Stream the sorted trace IDs of an event type in a compact binary form"""
+    logger.info(f"GET request received for a binary export of {event_type} trace IDs")
+
+    model = batch_writer.MODELS[event_type]
+    statement = select(model.trace_id).order_by(model.trace_id)
+    statement = trace_id_range(statement, model, after_trace_id, until_trace_id)
+    statement = trace_id_buckets(statement, model, buckets, bucket)
+    return Response(stream_with_context(stream_trace_ids(statement, encoding)), status=200,
+                    mimetype="application/octet-stream", headers={"X-Encoding": encoding})
+
+def get_pool_stats():
+    """Get connection pool usage and checkout wait times"""
+    stats = pool_stats()
+    logger.debug(f"Pool stats: {stats}")
+    return stats, 200
+
+class StreamedResponseBodyValidator(AbstractResponseBodyValidator):
+    """Connexion validates any */*json response, application/x-ndjson
+    included, by buffering the whole body and parsing it as one JSON
+    document. Streamed NDJSON responses are passed through as they are
+    produced instead."""
+
+    def wrap_send(self, send):
+        return send
+
+# Only the response validators are replaced, so the update must keep the others
+validator_map = {
+    "response": MediaTypeDict({**VALIDATOR_MAP["response"], "application/x-ndjson": StreamedResponseBodyValidator})
+}
+
 app = connexion.FlaskApp(__name__, specification_dir='')
-app.add_api('./openapi.yml', base_path="/storage", strict_validation=True, validate_responses=True)
+app.add_api('./openapi.yml', base_path="/storage", strict_validation=True, validate_responses=True,
+            validator_map=validator_map)
 if "CORS_ALLOW_ALL" in os.environ and os.environ["CORS_ALLOW_ALL"] == "yes":    
     app.add_middleware(
     CORSMiddleware,
@@ -184,5 +305,7 @@ if "CORS_ALLOW_ALL" in os.environ and os.environ["CORS_ALLOW_ALL"] == "yes":
     allow_headers=["*"],
     )
 if __name__ == '__main__':
-    setup_kafka_thread()
+    # In "external" mode the messages are consumed by consumer.py instead
+    if config.get('consumer', {}).get('mode', 'embedded') == 'embedded':
+        setup_kafka_thread()
     app.run(port=8090, host="0.0.0.0")
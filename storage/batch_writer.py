@@ -0,0 +1,206 @@
+import json
+import logging
+import time
+from sqlalchemy import select, text
+from sqlalchemy.dialects.mysql import insert
+from sqlalchemy.exc import OperationalError
+from pykafka.exceptions import KafkaException
+from db import make_session
+from db_class import RaceEvents, TelemetryData
+import counters
+
+logger = logging.getLogger("basicLogger")
+
+MODELS = {
+    "race_events": RaceEvents,
+    "telemetry_data": TelemetryData
+}
+
+def race_event_row(payload):
+    return {
+        "event_id": payload['event_id'],
+        "car_number": payload['car_number'],
+        "lap_number": payload['lap_number'],
+        "event_type": payload['event_type'],
+        "timestamp": int(payload['timestamp']),
+        "trace_id": payload['trace_id'],
+        "date_created": int(time.time())
+    }
+
+def telemetry_row(payload):
+    return {
+        "telemetry_id": payload['telemetry_id'],
+        "car_number": payload['car_number'],
+        "lap_number": payload['lap_number'],
+        "speed": payload['speed'],
+        "fuel_level": payload['fuel_level'],
+        "rpm": payload['rpm'],
+        "timestamp": int(payload['timestamp']),
+        "trace_id": payload['trace_id'],
+        "date_created": int(time.time())
+    }
+
+ID_FIELDS = {
+    "race_events": "event_id",
+    "telemetry_data": "telemetry_id"
+}
+
+ROW_BUILDERS = {
+    "race_events": race_event_row,
+    "telemetry_data": telemetry_row
+}
+
+def decode_message(msg):
+    """Turns a Kafka message into an (event_type, row) pair, or None if the
+    message cannot be stored."""
+    try:
+        event = json.loads(msg.value.decode('utf-8'))
+        return event["type"], ROW_BUILDERS[event["type"]](event["payload"])
+    except Exception as e:
+        logger.error("Skipping message at offset %s: %s", msg.offset, str(e))
+        return None
+
+# ER_DUP_ENTRY, the warning INSERT IGNORE leaves for a skipped duplicate
+DUPLICATE_KEY_WARNING = 1062
+
+def insert_new_rows(session, event_type, rows):
+    """Inserts the rows that are not already stored and returns how many were
+    inserted. Rows are identified by (trace_id, event id), so replaying the
+    same messages is a no-op."""
+    model = MODELS[event_type]
+    id_field = ID_FIELDS[event_type]
+    id_column = getattr(model, id_field)
+
+    statement = select(model.trace_id, id_column).where(model.trace_id.in_({row["trace_id"] for row in rows}))
+    seen = {tuple(result) for result in session.execute(statement)}
+    new_rows = []
+    for row in rows:
+        key = (row["trace_id"], row[id_field])
+        if key not in seen:
+            seen.add(key)
+            new_rows.append(row)
+    if not new_rows:
+        return 0
+
+    # INSERT IGNORE turns a concurrent insert of the same key (a rebalance
+    # replaying a batch the old owner is still writing) into a no-op instead
+    # of failing the whole batch. Ignored rows are not in the rowcount, so
+    # only rows that were really inserted reach the counters. A list of
+    # parameter sets makes SQLAlchemy use executemany, which the MySQL driver
+    # sends as a single multi-row INSERT and whose rowcount covers all rows.
+    statement = insert(model).prefix_with("IGNORE")
+    inserted = session.execute(statement, new_rows).rowcount
+
+    # IGNORE also downgrades data errors (values too long, out of range or of
+    # the wrong type) to warnings and stores the coerced row. Each skipped
+    # duplicate leaves exactly one warning, so any more warnings than that
+    # mean a row was coerced, and the batch fails the way it would without
+    # IGNORE. flush() rolls it back and stores the rows one at a time, which
+    # skips only the bad ones.
+    warning_count = session.execute(text("SELECT @@warning_count")).scalar()
+    if warning_count > len(new_rows) - inserted:
+        warnings = session.execute(text("SHOW WARNINGS")).fetchall()
+        raise ValueError("Rows rejected by the database: " +
+                         "; ".join(message for _, code, message in warnings if code != DUPLICATE_KEY_WARNING))
+    return inserted
+
+def write_batch(session, batch):
+    rows_by_type = {}
+    for event_type, row in batch:
+        rows_by_type.setdefault(event_type, []).append(row)
+
+    inserted = {}
+    for event_type, rows in rows_by_type.items():
+        inserted[event_type] = insert_new_rows(session, event_type, rows)
+    counters.increment(session, inserted)
+    session.commit()
+    skipped = len(batch) - sum(inserted.values())
+    if skipped:
+        logger.info("Skipped %d already stored messages", skipped)
+
+def write_rows_individually(batch):
+    """Fallback for a batch that the database rejected: store what can be
+    stored and skip the rows that fail on their own."""
+    for event_type, row in batch:
+        session = make_session()
+        try:
+            inserted = insert_new_rows(session, event_type, [row])
+            counters.increment(session, {event_type: inserted})
+            session.commit()
+        except OperationalError:
+            session.rollback()
+            raise
+        except Exception as e:
+            session.rollback()
+            logger.error("Failed to store %s with trace_id %s: %s", event_type, row.get("trace_id"), str(e))
+        finally:
+            session.close()
+
+def flush(batch, retry_backoff_ms):
+    """Writes a batch, retrying until the database accepts it. Only returns
+    once every row has either been stored or been rejected on its own."""
+    while True:
+        session = make_session()
+        try:
+            write_batch(session, batch)
+            return
+        except OperationalError as e:
+            session.rollback()
+            logger.error("Database unavailable while storing a batch of %d: %s", len(batch), str(e))
+        except Exception as e:
+            session.rollback()
+            logger.warning("Batch of %d was rejected (%s), storing rows one at a time", len(batch), str(e))
+            try:
+                write_rows_individually(batch)
+                return
+            except OperationalError as e:
+                logger.error("Database unavailable while storing rows one at a time: %s", str(e))
+        finally:
+            session.close()
+        time.sleep(retry_backoff_ms / 1000.0)
+
+def run(kafka_wrapper, max_batch_size=500, max_batch_ms=200, retry_backoff_ms=1000):
+    """Consumes messages into batches of up to max_batch_size messages or
+    max_batch_ms milliseconds, whichever comes first. Offsets are committed
+    only after the batch is in the database, so a crash replays the batch
+    instead of losing it (at-least-once)."""
+    batch = []
+    consumed = 0
+    deadline = None
+    while True:
+        try:
+            msg = kafka_wrapper.consumer.consume(block=True)
+        except KafkaException as e:
+            # The uncommitted messages are redelivered after reconnecting
+            logger.error("Error consuming messages: %s", str(e))
+            batch = []
+            consumed = 0
+            deadline = None
+            kafka_wrapper.reconnect()
+            continue
+
+        if msg is not None:
+            consumed += 1
+            item = decode_message(msg)
+            if item is not None:
+                batch.append(item)
+            if deadline is None:
+                deadline = time.monotonic() + max_batch_ms / 1000.0
+
+        if consumed == 0:
+            continue
+        if consumed < max_batch_size and time.monotonic() < deadline:
+            continue
+
+        start_time = time.monotonic()
+        if batch:
+            flush(batch, retry_backoff_ms)
+        try:
+            kafka_wrapper.consumer.commit_offsets()
+        except KafkaException as e:
+            logger.error("Failed to commit offsets, the batch will be redelivered: %s", str(e))
+            kafka_wrapper.reconnect()
+        logger.info("Stored batch of %d messages in %d ms", consumed, int((time.monotonic() - start_time) * 1000))
+        batch = []
+        consumed = 0
+        deadline = None
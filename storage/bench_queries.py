@@ -0,0 +1,89 @@
+"""Benchmark for the storage read queries with and without the secondary
+indexes from db_class.py.
+
+Runs against a scratch database given on the command line, never the one
+from storage_config.yml, because it drops and fills the tables:
+
+    python3 bench_queries.py mysql+pymysql://user:password@db:3306/bench 1000000
+"""
+import random
+import sys
+import time
+import uuid
+from sqlalchemy import create_engine, insert, select, func, text
+from sqlalchemy.orm import sessionmaker
+from db_class import Base, TelemetryData
+
+CHUNK_SIZE = 10000
+
+def populate(engine, rows):
+    start_timestamp = int(time.time()) - rows // 100
+    trace_id = time.time_ns()
+    with engine.begin() as connection:
+        for offset in range(0, rows, CHUNK_SIZE):
+            telemetry = []
+            for i in range(offset, min(offset + CHUNK_SIZE, rows)):
+                trace_id += random.randint(1, 1000)
+                telemetry.append({
+                    "telemetry_id": str(uuid.uuid4()),
+                    "car_number": random.randint(1, 20),
+                    "lap_number": random.randint(1, 78),
+                    "speed": random.randint(80, 340),
+                    "fuel_level": random.randint(0, 110),
+                    "rpm": random.randint(4000, 15000),
+                    "timestamp": start_timestamp + i // 100,
+                    "trace_id": str(trace_id),
+                    "date_created": start_timestamp + i // 100
+                })
+            connection.execute(insert(TelemetryData), telemetry)
+    return start_timestamp
+
+def time_query(session, statement, repeat=5):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        session.execute(statement).all()
+        timings.append(time.perf_counter() - start)
+    return min(timings) * 1000
+
+def run_queries(session, start_timestamp, rows):
+    window_start = start_timestamp + rows // 200
+    sample_trace_id = session.execute(select(TelemetryData.trace_id).limit(1).offset(rows // 2)).scalar()
+    queries = {
+        "timestamp range (10 s)": select(TelemetryData)
+            .where(TelemetryData.timestamp >= window_start)
+            .where(TelemetryData.timestamp < window_start + 10),
+        "trace_id lookup": select(TelemetryData).where(TelemetryData.trace_id == sample_trace_id),
+        "car/lap lookup": select(func.count()).select_from(TelemetryData)
+            .where(TelemetryData.car_number == 7).where(TelemetryData.lap_number == 40),
+        "telemetry_ids scan": select(TelemetryData.telemetry_id, TelemetryData.trace_id),
+    }
+    return {name: time_query(session, statement) for name, statement in queries.items()}
+
+def main(url, rows):
+    engine = create_engine(url)
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    table = TelemetryData.__table__
+
+    print(f"Inserting {rows} telemetry rows...")
+    start_timestamp = populate(engine, rows)
+    session = sessionmaker(bind=engine)()
+
+    indexed = run_queries(session, start_timestamp, rows)
+
+    for index in table.indexes:
+        index.drop(engine)
+    with engine.begin() as connection:
+        connection.execute(text(f"ALTER TABLE {table.name} DROP INDEX uq_telemetry_data_trace_id"))
+    unindexed = run_queries(session, start_timestamp, rows)
+    session.close()
+
+    print(f"{'query':<25}{'no index (ms)':>16}{'indexed (ms)':>16}")
+    for name in indexed:
+        print(f"{name:<25}{unindexed[name]:>16.2f}{indexed[name]:>16.2f}")
+
+    Base.metadata.drop_all(engine)
+
+if __name__ == "__main__":
+    main(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 1000000)
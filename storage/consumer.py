@@ -0,0 +1,71 @@
+"""Runs the storage Kafka consumers in their own processes, separately from
+the Flask API:
+
+    python3 consumer.py
+
+Starts consumer.workers processes that each join the storage consumer group
+with a balanced consumer. Kafka assigns every partition to exactly one of
+them, so each partition has a single writer. The receiver keys messages by
+car_number, which keeps every car's events in order. Set consumer.mode to
+"external" in storage_config.yml so the API does not consume as well.
+"""
+import logging
+import logging.config
+import multiprocessing
+import os
+import time
+import yaml
+
+os.environ["LOG_FILENAME"] = "/app/logs/storage_consumer.log"
+
+with open('/app/config/log_config.yml', 'r') as f:
+    log_config = yaml.safe_load(f)
+logging.config.dictConfig(log_config)
+logger = logging.getLogger("basicLogger")
+
+with open('/app/config/storage/storage_config.yml', 'r') as f:
+    config = yaml.safe_load(f)
+
+from db import engine
+from kafka_wrapper import KafkaProducerWrapper
+import batch_writer
+
+def run_worker(worker_id):
+    # Connections inherited from the parent process must not be shared
+    engine.dispose(close=False)
+
+    batch_config = config.get('batch', {})
+    kafka_consumer = KafkaProducerWrapper(
+        hostname=f"{config['events']['hostname']}:{config['events']['port']}",
+        topic=config['events']['topic'],
+        consumer_group=config['events'].get('consumer_group', 'storage_group'),
+        consumer_timeout_ms=batch_config.get('max_ms', 200),
+        balanced=True
+    )
+    logger.info("Storage consumer worker %d started", worker_id)
+    batch_writer.run(
+        kafka_consumer,
+        max_batch_size=batch_config.get('max_size', 500),
+        max_batch_ms=batch_config.get('max_ms', 200),
+        retry_backoff_ms=batch_config.get('retry_backoff_ms', 1000)
+    )
+
+def start_worker(worker_id):
+    process = multiprocessing.Process(target=run_worker, args=(worker_id,), name=f"storage-consumer-{worker_id}")
+    process.start()
+    return process
+
+def main():
+    workers = config.get('consumer', {}).get('workers', 1)
+    processes = [start_worker(worker_id) for worker_id in range(workers)]
+    logger.info("Started %d storage consumer workers", workers)
+
+    while True:
+        time.sleep(5)
+        for worker_id, process in enumerate(processes):
+            if not process.is_alive():
+                logger.error("Storage consumer worker %d exited with code %s, restarting", worker_id, process.exitcode)
+                processes[worker_id] = start_worker(worker_id)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+import logging
+from sqlalchemy import select, func
+from sqlalchemy.dialects.mysql import insert
+from db_class import RaceEvents, TelemetryData, RecordCounts
+
+logger = logging.getLogger("basicLogger")
+
+COUNTED_MODELS = {
+    RaceEvents.__tablename__: RaceEvents,
+    TelemetryData.__tablename__: TelemetryData
+}
+
+def increment(session, counts):
+    """Adds the number of inserted rows per table to the counters. Must run
+    in the same transaction as the inserts so both commit together."""
+    for table_name, count in counts.items():
+        if not count:
+            continue
+        statement = insert(RecordCounts).values(table_name=table_name, count=count)
+        statement = statement.on_duplicate_key_update(count=RecordCounts.count + statement.inserted.count)
+        session.execute(statement)
+
+def read_counts(session):
+    counts = {table_name: 0 for table_name in COUNTED_MODELS}
+    for table_name, count in session.execute(select(RecordCounts.table_name, RecordCounts.count)):
+        counts[table_name] = count
+    return counts
+
+def reconcile(session):
+    """Rebuilds the counters from a real COUNT of each table. The counter rows
+    are locked first, which holds back writers until the new values are
+    committed, so no increment is lost in between."""
+    session.execute(select(RecordCounts).with_for_update())
+    counts = {}
+    for table_name, model in COUNTED_MODELS.items():
+        counts[table_name] = session.execute(select(func.count()).select_from(model)).scalar()
+        statement = insert(RecordCounts).values(table_name=table_name, count=counts[table_name])
+        statement = statement.on_duplicate_key_update(count=statement.inserted.count)
+        session.execute(statement)
+    session.commit()
+    logger.info("Record counters reconciled: %s", counts)
+    return counts
+
+if __name__ == "__main__":
+    from db import make_session
+    session = make_session()
+    try:
+        print(f"Record counters reconciled: {reconcile(session)}")
+    finally:
+        session.close()
@@ -1,6 +1,9 @@
+import threading
+import time
 import yaml
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 
 config_file = "/app/config/storage/storage_config.yml"
 with open(config_file, "r") as f:
@@ -12,8 +15,75 @@ password = datastore["password"]
 hostname = datastore["hostname"]
 port = datastore["port"]
 database = datastore["db"]
+pool_config = datastore.get("pool", {})
 
-engine = create_engine(f"mysql+pymysql://{user}:{password}@{hostname}:{port}/{database}")
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that records how long callers wait to check out a connection."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats_lock = threading.Lock()
+        self.checkout_count = 0
+        self.checkout_wait_total = 0.0
+        self.checkout_wait_max = 0.0
+        self.checkout_timeouts = 0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except Exception:
+            with self.stats_lock:
+                self.checkout_timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - start
+            with self.stats_lock:
+                self.checkout_count += 1
+                self.checkout_wait_total += waited
+                self.checkout_wait_max = max(self.checkout_wait_max, waited)
+
+    def recreate(self):
+        # Called when the engine is disposed, carry the counters over
+        new_pool = super().recreate()
+        new_pool.checkout_count = self.checkout_count
+        new_pool.checkout_wait_total = self.checkout_wait_total
+        new_pool.checkout_wait_max = self.checkout_wait_max
+        new_pool.checkout_timeouts = self.checkout_timeouts
+        return new_pool
+
+    def stats(self):
+        with self.stats_lock:
+            checkouts = self.checkout_count
+            return {
+                "pool_size": self.size(),
+                "max_overflow": self._max_overflow,
+                "checked_out": self.checkedout(),
+                "checked_in": self.checkedin(),
+                "overflow": max(self.overflow(), 0),
+                "utilisation": self.checkedout() / (self.size() + max(self._max_overflow, 0)),
+                "checkouts": checkouts,
+                "checkout_timeouts": self.checkout_timeouts,
+                "checkout_wait_avg_ms": (self.checkout_wait_total / checkouts * 1000) if checkouts else 0.0,
+                "checkout_wait_max_ms": self.checkout_wait_max * 1000
+            }
+
+# One engine and one session factory for the whole process: the Flask request
+# threads and the Kafka consumer thread all draw from this pool
+engine = create_engine(
+    f"mysql+pymysql://{user}:{password}@{hostname}:{port}/{database}",
+    poolclass=InstrumentedQueuePool,
+    pool_size=pool_config.get("size", 10),
+    max_overflow=pool_config.get("max_overflow", 10),
+    pool_timeout=pool_config.get("timeout", 30),
+    pool_recycle=pool_config.get("recycle", 1800),
+    pool_pre_ping=pool_config.get("pre_ping", True)
+)
+
+Session = sessionmaker(bind=engine)
 
 def make_session():
-    return sessionmaker(bind=engine)()
\ No newline at end of file
+    return Session()
+
+def pool_stats():
+    return engine.pool.stats()
\ No newline at end of file
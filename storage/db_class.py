@@ -1,5 +1,5 @@
 from sqlalchemy.orm import DeclarativeBase, mapped_column
-from sqlalchemy import Integer, String, DateTime, func
+from sqlalchemy import BigInteger, Integer, String, DateTime, Index, UniqueConstraint, func
 import time
 
 class Base(DeclarativeBase):
@@ -7,6 +7,15 @@ class Base(DeclarativeBase):
 
 class RaceEvents(Base):
     __tablename__ = "race_events"
+    # A redelivered Kafka message carries the same trace_id and event_id, so
+    # this key is what makes replaying the topic safe. It also serves as the
+    # trace_id index and covers the /event_ids scan.
+    # Run db_migrate.py after changing these to add them to a live database.
+    __table_args__ = (
+        UniqueConstraint("trace_id", "event_id", name="uq_race_events_trace_id"),
+        Index("ix_race_events_timestamp", "timestamp"),
+        Index("ix_race_events_car_lap", "car_number", "lap_number"),
+    )
     id = mapped_column(Integer, primary_key=True, autoincrement=True)
     event_id = mapped_column(String(50), nullable=False)
     car_number = mapped_column(Integer, nullable=False)
@@ -18,6 +27,7 @@ class RaceEvents(Base):
 
     def to_json(self):
         return {
+            "id": self.id,
             "event_id": self.event_id,
             "car_number": self.car_number,
             "lap_number": self.lap_number,
@@ -29,6 +39,11 @@ class RaceEvents(Base):
         
 class TelemetryData(Base):
     __tablename__ = "telemetry_data"
+    __table_args__ = (
+        UniqueConstraint("trace_id", "telemetry_id", name="uq_telemetry_data_trace_id"),
+        Index("ix_telemetry_data_timestamp", "timestamp"),
+        Index("ix_telemetry_data_car_lap", "car_number", "lap_number"),
+    )
     id = mapped_column(Integer, primary_key=True, autoincrement=True)
     telemetry_id = mapped_column(String(50), nullable=False)
     car_number = mapped_column(Integer, nullable=False)
@@ -42,6 +57,7 @@ class TelemetryData(Base):
 
     def to_json(self):
         return {
+            "id": self.id,
             "telemetry_id": self.telemetry_id,
             "car_number": self.car_number,
             "lap_number": self.lap_number,
@@ -51,4 +67,11 @@ class TelemetryData(Base):
             "timestamp": self.timestamp,
             "trace_id": self.trace_id,
             "date_created": self.date_created
-        }
\ No newline at end of file
+        }
+
+class RecordCounts(Base):
+    """Row count per table, kept up to date by the write path so that
+    /record_count does not have to count the tables."""
+    __tablename__ = "record_counts"
+    table_name = mapped_column(String(50), primary_key=True)
+    count = mapped_column(BigInteger, nullable=False, default=0)
\ No newline at end of file
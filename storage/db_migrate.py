@@ -0,0 +1,67 @@
+import sys
+from sqlalchemy import inspect, text, UniqueConstraint
+from sqlalchemy.exc import OperationalError, IntegrityError
+from sqlalchemy.schema import AddConstraint
+from db_class import Base, RaceEvents, TelemetryData, RecordCounts
+from db import engine, make_session
+import counters
+
+# Columns that identify a duplicate row, see the unique keys in db_class.py
+DEDUPE_KEYS = {
+    RaceEvents.__tablename__: ("trace_id", "event_id"),
+    TelemetryData.__tablename__: ("trace_id", "telemetry_id")
+}
+
+def remove_duplicates(table_name):
+    """Keeps the oldest copy of every duplicated row so that the unique key
+    can be added."""
+    conditions = " AND ".join(f"newer.{column} = older.{column}" for column in DEDUPE_KEYS[table_name])
+    with engine.begin() as connection:
+        result = connection.execute(text(
+            f"DELETE newer FROM {table_name} newer JOIN {table_name} older "
+            f"ON {conditions} AND newer.id > older.id"
+        ))
+    print(f"Removed {result.rowcount} duplicate rows from {table_name}.")
+
+def migrate(dedupe=False):
+    """Brings an existing database up to date with db_class.py without
+    dropping anything: creates missing tables, then adds missing indexes
+    and unique keys to the tables that already exist."""
+    existing_tables = set(inspect(engine).get_table_names())
+    Base.metadata.create_all(engine)
+
+    if RecordCounts.__tablename__ not in existing_tables:
+        session = make_session()
+        try:
+            print(f"Initialised record counters: {counters.reconcile(session)}")
+        finally:
+            session.close()
+
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        # MySQL reports unique keys as indexes as well
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        existing |= {constraint["name"] for constraint in inspector.get_unique_constraints(table.name)}
+
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+            print(f"Creating index {index.name} on {table.name}...")
+            index.create(engine)
+
+        for constraint in table.constraints:
+            if not isinstance(constraint, UniqueConstraint) or constraint.name in existing:
+                continue
+            if dedupe and table.name in DEDUPE_KEYS:
+                remove_duplicates(table.name)
+            print(f"Creating unique key {constraint.name} on {table.name}...")
+            try:
+                with engine.begin() as connection:
+                    connection.execute(AddConstraint(constraint))
+            except (IntegrityError, OperationalError) as e:
+                print(f"Could not create {constraint.name}, run with --dedupe to remove duplicate rows first: {e}")
+
+    print("Migration complete.")
+
+if __name__ == "__main__":
+    migrate(dedupe="--dedupe" in sys.argv)